@@ -12,11 +12,9 @@
 
 FILE uart;
 
-static void uart_putchar(uint8_t c) {
-    if (c == '\n') {
-		loop_until_bit_is_set(UCSR0A, UDRE0); /* Wait until data register empty. */
-		UDR0 = '\r';
-    }
+/* Send one byte as-is. Everything sent to the host is binary, so this is
+ * what the protocol uses; only stdio text gets newline translation. */
+static void uart_putbyte(uint8_t c) {
     loop_until_bit_is_set(UCSR0A, UDRE0); /* Wait until data register empty. */
     UDR0 = c;
 }
@@ -25,7 +23,9 @@ static int stdio_uart_putchar(char c, FILE *handle)
 {
 	(void) handle;
 
-	uart_putchar(c);
+	if (c == '\n')
+		uart_putbyte('\r');
+	uart_putbyte(c);
 	return 0;
 }
 
@@ -70,6 +70,40 @@ struct maplepacket {
 	unsigned char data[1536]; /* Our maximum packet size */
 } packet;
 
+/* Options the host can ask for in the recv_skip field of an are-you-there
+ * packet. Must match OPTION_* in maple.py. */
+#define OPTION_RLE 0x01 /* Run-length encode replies */
+#define OPTION_BATCH 0x02 /* Several packets in one go */
+
+/* Batches are read into their own buffer before any of them are sent, which
+ * only fits on chips with more RAM than the 328. Only the 2560's receive
+ * routine has a watchdog, too, so a batch can't stall on a missing device.
+ * Must match BATCH_BUFFER_SIZE in maple.py. */
+#if RAMEND > 0x1000
+#define BATCH_BUFFER_SIZE 1024
+#define SUPPORTED_OPTIONS (OPTION_RLE | OPTION_BATCH)
+#else
+#define SUPPORTED_OPTIONS (OPTION_RLE)
+#endif
+
+/* recv_skip of an are-you-there packet which starts a batch, ORed with the
+ * number of packets in it. */
+#define BATCH_MARKER 0x8000
+
+#define HANDSHAKE_REPLY 1
+#define OPTIONS_REPLY 2
+
+/* A run of idle (0xff) bytes is sent as RLE_ESCAPE followed by its length. */
+#define RLE_ESCAPE 0xff
+#define RLE_MAX_RUN 255
+
+uint8_t options;
+
+#ifdef BATCH_BUFFER_SIZE
+/* Each packet of a batch as it arrived: length, recv_skip, data. */
+unsigned char batch_buffer[BATCH_BUFFER_SIZE];
+#endif
+
 void setup()
 {
 	// Initialise serial port
@@ -183,20 +217,136 @@ packet_dest_is_maple(void)
 	return packet.data_len > 0;
 }
 
+/* Length of the next run of RLE_ESCAPE bytes starting at i, up to RLE_MAX_RUN. */
+static uint8_t
+rle_run_length(int i)
+{
+	uint8_t run = 0;
+
+	while(i < packet.data_len_rx && packet.data[i] == RLE_ESCAPE && run < RLE_MAX_RUN) {
+		run ++;
+		i ++;
+	}
+	return run;
+}
+
+/* Send the rx buffer run-length encoded. There's no room to encode into, so
+ * this goes over the buffer twice: once to work out the length to send
+ * first, and once to send it. */
+static void
+send_packet_rle(void)
+{
+	uint16_t encoded_len = 0;
+	uint8_t run;
+	int i;
+
+	for(i = 0; i < packet.data_len_rx; ) {
+		run = rle_run_length(i);
+		if(run) {
+			encoded_len += 2;
+			i += run;
+		} else {
+			encoded_len ++;
+			i ++;
+		}
+	}
+
+	uart_putbyte((encoded_len & 0xff00) >> 8);
+	uart_putbyte(encoded_len & 0xff);
+
+	for(i = 0; i < packet.data_len_rx; ) {
+		run = rle_run_length(i);
+		if(run) {
+			uart_putbyte(RLE_ESCAPE);
+			uart_putbyte(run);
+			i += run;
+		} else {
+			uart_putbyte(packet.data[i]);
+			i ++;
+		}
+	}
+}
+
 void
 send_packet(void)
 {
-	uart_putchar((packet.data_len_rx & 0xff00) >> 8);
-	uart_putchar(packet.data_len_rx & 0xff);
+	if(options & OPTION_RLE) {
+		send_packet_rle();
+		return;
+	}
+
+	uart_putbyte((packet.data_len_rx & 0xff00) >> 8);
+	uart_putbyte(packet.data_len_rx & 0xff);
 	if(packet.data_len_rx) {
 		int i;
 		uint8_t *data = packet.data;
 		for (i = 0; i < packet.data_len_rx; i++) {
-			uart_putchar(data[i]);
+			uart_putbyte(data[i]);
 		}
 	}
 }
 
+/* Reply to an are-you-there packet. Older hosts always send recv_skip 0 and
+ * expect HANDSHAKE_REPLY, which also turns any options off. */
+void
+send_handshake(void)
+{
+	if(packet.recv_skip) {
+		options = packet.recv_skip & SUPPORTED_OPTIONS;
+		uart_putbyte(OPTIONS_REPLY);
+		uart_putbyte(options);
+	} else {
+		options = 0;
+		uart_putbyte(HANDSHAKE_REPLY);
+	}
+}
+
+#ifdef BATCH_BUFFER_SIZE
+/* Read every packet of a batch, then send each one and its reply in turn. */
+void
+run_batch(uint16_t count)
+{
+	unsigned char *ptr = batch_buffer;
+	uint16_t stored = 0;
+	uint16_t i;
+	uint8_t j;
+
+	for(i = 0; i < count; i++) {
+		uint8_t len = uart_getchar();
+		if(stored == i && ptr + 3 + len <= batch_buffer + BATCH_BUFFER_SIZE) {
+			*ptr++ = len;
+			*ptr++ = uart_getchar();
+			*ptr++ = uart_getchar();
+			for(j = 0; j < len; j++)
+				*ptr++ = uart_getchar();
+			stored ++;
+		} else {
+			/* The host keeps batches small enough, so this is a protocol
+			 * error. Drop this packet and the rest: their replies will
+			 * be empty. */
+			uart_getshort();
+			for(j = 0; j < len; j++)
+				uart_getchar();
+		}
+	}
+
+	ptr = batch_buffer;
+	for(i = 0; i < count; i++) {
+		if(i < stored) {
+			packet.data_len = *ptr++;
+			packet.recv_skip = (uint16_t)ptr[0] | ((uint16_t)ptr[1] << 8);
+			ptr += 2;
+			for(j = 0; j < packet.data_len; j++)
+				packet.data[j] = *ptr++;
+			maple_transact();
+		} else {
+			packet.data_len_rx = 0;
+		}
+		send_packet();
+	}
+}
+#endif
+
 void main() __attribute__ ((noreturn));
 void main(void) {
     setup();
@@ -223,9 +373,12 @@ void main(void) {
 			maple_transact();
 			//debug(1);
 			send_packet();
+#ifdef BATCH_BUFFER_SIZE
+		} else if(packet.recv_skip & BATCH_MARKER) {
+			run_batch(packet.recv_skip & ~BATCH_MARKER);
+#endif
 		} else {
-			// Debug
-			uart_putchar(1);
+			send_handshake();
 		}
 		debug(1);
 	}
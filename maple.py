@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 # copy of large chunks of maple.py for debug / testing purposes.
+import os
+import re
 import sys
 import struct
 import select
@@ -8,6 +10,9 @@ import time
 import argparse
 import collections
 
+from maple_frame import Frame, swapwords, compute_checksum
+from maple_stitch import ReplyStitcher, SkipCalibration
+
 PORT='/dev/tty.usbserial-A700ekGi'    # OS X (or similar)
 FN_CONTROLLER  = 1
 FN_MEMORY_CARD = 2
@@ -61,14 +66,47 @@ IDLE_SAMPLES_INDICATING_COMPLETION = 8
 
 SKIP_LOOP_LENGTH = 2  # size is given in samples
 
-# Safety factor for skip loop to give us a chance to align subsequences -- turns out not to be needed
+# Safety factor for skip loop to give us a chance to align subsequences. MapleProxy overlaps passes and
+# aligns them itself (see maple_stitch), so this is only used by calculate_recv_skip.
 RX_SKIP_SAFETY_FACTOR = 0  # samples
 
 # Number of samples stored per byte.
 RAW_SAMPLES_PER_BYTE = 4
 
+# Raw responses are read and decoded in chunks of this many bytes.
+STREAM_CHUNK_SIZE = 64
+
+# Number of times to try a transaction whose reply fails validation.
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Options the host can ask the proxy for, as a bitmask in the recv_skip field of an are-you-there
+# frame. Proxies which know about options reply OPTIONS_REPLY followed by the options they accepted;
+# older ones just reply HANDSHAKE_REPLY. A plain are-you-there (recv_skip 0) turns all options off.
+OPTION_RLE = 0x01  # Replies are run-length encoded: see rle_encode.
+OPTION_BATCH = 0x02  # Several frames can be sent at once: see MapleProxy.transact_batch.
+SUPPORTED_OPTIONS = OPTION_RLE | OPTION_BATCH
+HANDSHAKE_REPLY = b'\x01'
+OPTIONS_REPLY = b'\x02'
+
+# In a run-length encoded reply, this byte is followed by a count of how many times it repeats. It is
+# the raw byte for four idle (both lines high) samples.
+RLE_ESCAPE = 0xff
+RLE_RUN = re.compile(b'\xff{1,255}')
+
+# A batch starts with an are-you-there frame whose recv_skip is BATCH_MARKER | the number of frames.
+# The proxy reads every frame into a buffer of BATCH_BUFFER_SIZE bytes (counting each frame's length
+# and recv_skip prefix) before running them, and then sends back each reply in turn.
+BATCH_MARKER = 0x8000
+BATCH_BUFFER_SIZE = 1024
+
+# What transact_batch is recorded as in metrics.
+BATCH_LABEL = 'batch'
+
 log = print
 
+class MapleError(Exception):
+    pass
+
 def debug_hex(packet):
     def ascii(b):
         return ' %c' % (b,) if 32 <= b <= 127 else '%02x' % (b,)
@@ -87,13 +125,6 @@ def print_header(data):
     command   = data[3]
     print("Command %x sender %x recipient %x length %x" % (command, recipient, sender, words))
 
-def swapwords(s):
-    swapped = []
-    while s:
-        swapped.append(s[:4][-1::-1])
-        s = s[4:]
-    return b''.join(swapped)
-
 def get_command(data):
     if data:
         return data[3]
@@ -131,10 +162,33 @@ def print_controller_info(data):
     print(", ".join(button_names))
     #print debug_hex(data)
 
+LCD_WIDTH = 48
+LCD_HEIGHT = 32
+
+def lcd_bit_position(x, y):
+    """
+    Return the (byte, bit) of the LCD data holding pixel (x, y), where y counts up from the bottom row.
+    """
+    stride = LCD_WIDTH
+    byte = (x + (y * stride)) // 8
+    bit  = (x + (y * stride)) % 8
+    # Magical transformations! 
+    # Brilliant memory layout here
+    if y % 2 == 0:
+        if x < 16:
+            byte += (stride // 8)
+        else:
+            byte -= 2
+    if y % 2 == 1:
+        if x < 32:
+            byte += 2
+        else:
+            byte -= (stride // 8)
+    return byte, bit
+
 def load_image(filename):
-    data = [0] * ((48 * 32) // 8)
+    data = [0] * ((LCD_WIDTH * LCD_HEIGHT) // 8)
     x = y = 0
-    stride = 48
     if hasattr(filename, 'readlines'):
         # Treat it as a handle
         lines = filename.readlines()
@@ -148,36 +202,61 @@ def load_image(filename):
             line = line[:-1]
         for x in range(len(line)):
             if line[x] != ' ':
-                byte = (x + (y * stride)) // 8
-                bit  = (x + (y * stride)) % 8
-                # Magical transformations! 
-                # Brilliant memory layout here
-                if y % 2 == 0:
-                    if x < 16:
-                        byte += (stride // 8)
-                    else:
-                        byte -= 2
-                if y % 2 == 1:
-                    if x < 32:
-                        byte += 2
-                    else:
-                        byte -= (stride // 8)
-
+                byte, bit = lcd_bit_position(x, y)
                 data[byte] |= 1 << bit
         y += 1
-    assert len(data) == 48 * 32 // 8
+    assert len(data) == LCD_WIDTH * LCD_HEIGHT // 8
     return bytes(data)
 
+def lcd_payload(lcddata):
+    """
+    Return the CMD_WRITE payload which puts lcddata on the LCD.
+    """
+    assert len(lcddata) == LCD_WIDTH * LCD_HEIGHT // 8
+    return struct.pack("<II", FN_LCD, 0) + lcddata
+
+def frame_length(num_words):
+    """
+    Length of a whole frame, checksum included, whose header gives num_words words of payload.
+    """
+    return 4 + 4 * num_words + 1
+
 # result = decoded data
 # num_samples = number of useful (bit-generating) samples
 # recv_completed = no data cut off due to space constraints
-DecodedRx = collections.namedtuple('DecodedRx', ('result', 'num_samples', 'completed'))
-def debittify(bitstring):
+# checksum = the frame's checksum byte, which is not included in the result (only if completed)
+# partial holds the bits after the last whole byte, as (bits, number of bits).
+# expected = length of the whole frame according to its header, if the pass started at the header
+# end_bits = bits decoded after a frame completed by its header, up to the first raw byte of idle lines:
+#   the end-of-frame sequence's stray bits. None if the lines weren't seen going idle.
+class DecodedRx(collections.namedtuple('DecodedRx', ('result', 'num_samples', 'completed', 'checksum',
+        'partial', 'expected', 'end_bits'), defaults=(None, (0, 0), None, None))):
+    __slots__ = ()
+
+    @property
+    def missing(self):
+        """
+        Bytes of the frame which never arrived, if the reply ended before its header said it would.
+        """
+        if not self.completed or self.expected is None:
+            return 0
+        return max(0, self.expected - len(self.result) - (self.checksum is not None))
+
+def describe_rx(rx_response):
+    if rx_response.missing:
+        return 'truncated, %d of %d bytes' % (rx_response.expected - rx_response.missing, rx_response.expected)
+    return 'complete' if rx_response.completed else 'incomplete'
+
+def debittify(bitstring, header=True):
     """
     The maple proxy sends a bitstring consisting of the state of the two pins sampled at 2MSPS. Decode these 
     back into bytes.
     
     We also want a sample count back from this, so return a DecodedRx.
+
+    If header is set, the bitstring starts at the beginning of a frame, and decoding stops as soon as
+    the frame's header says it's all in. Otherwise the reply only counts as complete once the lines go
+    idle.
     """
     def iter_bits():
         # Order of bits: 33 11 22 44
@@ -190,6 +269,7 @@ def debittify(bitstring):
     output = []
     accum = 0
     bitcount = 0
+    samples = iter_bits()
 
     def add_bit(thebit):
         nonlocal accum, bitcount, output
@@ -212,7 +292,10 @@ def debittify(bitstring):
     debug_bits_list = []
     num_samples_all_high = 0  # in a row
     samples_this_byte = 0  # useful at the end for calculating total number of samples.
-    for pin5, pin1 in iter_bits():
+    expected = None
+    stop_at = 4 if header else sys.maxsize  # Length of output at which to look at the header, or stop
+    num_samples = None  # Only set if decoding stopped at the end of the frame
+    for sample_idx, (pin5, pin1) in enumerate(samples):
         debug_bits = '%c%c' % ('1' if pin5 else '0', '1' if pin1 else '0')
 
         if pin1 and pin5:
@@ -253,6 +336,13 @@ def debittify(bitstring):
 
         debug_bits_list.append(debug_this_time)
 
+        if len(output) >= stop_at:
+            if expected is None:
+                stop_at = expected = frame_length(output[0])
+            else:
+                num_samples = sample_idx + 1
+                break
+
     # debug:
     debug = False
     if debug:
@@ -284,218 +374,926 @@ def debittify(bitstring):
         #print('debit', '{0:08b}{1:08b}{2:08b}{3:08b}'.format(output[0], output[1], output[2], output[3]))
         print('bitcount', bitcount)
 
+    if num_samples is not None:
+        # The whole frame, as given by its header, is in. Only the end-of-frame sequence after it is
+        # looked at, for its stray bits.
+        end_bits = bitcount
+        idle_this_byte = 0
+        for sample_idx, (pin5, pin1) in enumerate(samples, sample_idx + 1):
+            if sample_idx % RAW_SAMPLES_PER_BYTE == 0:
+                idle_this_byte = 0
+            if pin1 and pin5:
+                idle_this_byte += 1
+                if idle_this_byte == RAW_SAMPLES_PER_BYTE:
+                    break
+            end_bits += bool(old_pin1 and not pin1) + bool(old_pin5 and not pin5)
+            old_pin1 = pin1
+            old_pin5 = pin5
+        else:
+            end_bits = None
+        return DecodedRx(result=bytes(output[:expected - 1]), num_samples=num_samples, completed=True,
+                checksum=output[expected - 1], expected=expected, end_bits=end_bits)
+
     # the recv was completed if at least the last IDLE_SAMPLES_INDICATING_COMPLETION samples
     # are all '11'.
     recv_completed = num_samples_all_high >= IDLE_SAMPLES_INDICATING_COMPLETION
 
-    if recv_completed:
-        # TODO: why?
+    checksum = None
+    if recv_completed and output:
+        # The final byte is the frame checksum.
+        checksum = output[-1]
         output = output[:-1]
 
     num_samples = (len(bitstring) * RAW_SAMPLES_PER_BYTE) - samples_this_byte
-    return DecodedRx(result=bytes(output), num_samples=num_samples, completed=recv_completed)
+    return DecodedRx(result=bytes(output), num_samples=num_samples, completed=recv_completed,
+            checksum=checksum, partial=(accum, bitcount), expected=expected)
 
-def align_messages(prev, current):
-    return prev + current
+# Decoder state for StreamDecoder: either "started" (still skipping the initial both-lines-high
+# samples), or the previous pin 1 and pin 5 values plus the number of bits in the accumulator.
+STREAM_STATE_STARTED = 32
+
+def _stream_state(old_pin1, old_pin5, bitcount):
+    return (old_pin1 << 4) | (old_pin5 << 3) | bitcount
+
+def _build_stream_table():
+    """
+    Precompute the effect of every raw byte on every decoder state. Each entry is a tuple of:
+    (next state, number of bits produced, the bits themselves, samples after the last byte completed
+    in this raw byte or None, number of samples processed, trailing run of idle samples, whether all
+    processed samples were idle).
+    """
+    table = [None] * ((STREAM_STATE_STARTED + 1) * 256)
+    for state in range(STREAM_STATE_STARTED + 1):
+        for byte in range(256):
+            started = state == STREAM_STATE_STARTED
+            if started:
+                old_pin1, old_pin5, bitcount = 1, 0, 0
+            else:
+                old_pin1, old_pin5, bitcount = (state >> 4) & 1, (state >> 3) & 1, state & 7
+
+            num_bits = bits = processed = idle_run = 0
+            all_idle = True
+            reset_tail = None
+            # Order of bits: 33 11 22 44
+            for shift in (4, 2, 6, 0):
+                pin5 = (byte >> (shift + 1)) & 1
+                pin1 = (byte >> shift) & 1
+                if pin1 and pin5:
+                    if started:
+                        continue
+                    idle_run += 1
+                else:
+                    idle_run = 0
+                    all_idle = False
+
+                started = False
+                processed += 1
+
+                added = False
+                if old_pin1 and not pin1:
+                    bits = (bits << 1) | pin5
+                    num_bits += 1
+                    bitcount = (bitcount + 1) % 8
+                    added = bitcount == 0
+                if old_pin5 and not pin5:
+                    bits = (bits << 1) | pin1
+                    num_bits += 1
+                    bitcount = (bitcount + 1) % 8
+                    added = bitcount == 0
+
+                if added:
+                    reset_tail = 0
+                elif reset_tail is not None:
+                    reset_tail += 1
+
+                old_pin1 = pin1
+                old_pin5 = pin5
+
+            next_state = STREAM_STATE_STARTED if started else _stream_state(old_pin1, old_pin5, bitcount)
+            table[(state << 8) | byte] = (next_state, num_bits, bits, reset_tail, processed, idle_run,
+                    all_idle)
+    return table
+
+STREAM_TABLE = _build_stream_table()
+
+class StreamDecoder(object):
+    """
+    Incremental version of debittify: feed it raw sample data as it arrives from the proxy and it
+    decodes as it goes, carrying edge and bit-accumulator state across chunks. One table lookup is
+    done per raw byte.
+
+    result() returns the same DecodedRx that debittify would for everything fed so far. As there, with
+    header set the decoder stops once the frame's header says it's all in. After that only the
+    end-of-frame sequence is looked at, and once the lines go idle it's finished: anything fed then
+    is ignored.
+    """
+    def __init__(self, header=True):
+        self.header = header
+        self.expected = None
+        self.done = False  # The whole frame is in
+        self.end_bits = None  # Stray bits after the frame, counted until the lines go idle
+        self.finished = False  # Done, and the lines have gone idle since
+        self.state = STREAM_STATE_STARTED
+        self.accum = 0
+        self.bitcount = 0
+        self.output = bytearray()
+        self.num_raw_bytes = 0
+        self.samples_this_byte = 0
+        self.num_samples_all_high = 0
+
+    @property
+    def completed(self):
+        return self.done or self.num_samples_all_high >= IDLE_SAMPLES_INDICATING_COMPLETION
+
+    def feed(self, chunk):
+        """
+        Decode a chunk of raw data and return any newly-completed bytes.
+        """
+        if self.done:
+            if not self.finished:
+                self._count_end_bits(chunk)
+            return b''
+
+        table = STREAM_TABLE
+        output = self.output
+        state = self.state
+        accum = self.accum
+        bitcount = self.bitcount
+        samples_this_byte = self.samples_this_byte
+        num_samples_all_high = self.num_samples_all_high
+        start = len(output)
+        # Length of output at which to look at the header, or stop.
+        stop_at = self.expected or (4 if self.header else -1)
+
+        raw_bytes = iter(chunk)
+        for byte in raw_bytes:
+            state, num_bits, bits, reset_tail, processed, idle_run, all_idle = table[(state << 8) | byte]
+
+            if num_bits:
+                accum = (accum << num_bits) | bits
+                bitcount += num_bits
+                if bitcount >= 8:
+                    bitcount -= 8
+                    output.append((accum >> bitcount) & 0xff)
+                    accum &= (1 << bitcount) - 1
+                    if len(output) == stop_at:
+                        if self.expected is None:
+                            stop_at = self.expected = frame_length(output[0])
+                        else:
+                            rest = bytes(raw_bytes)
+                            self._stop(len(chunk) - len(rest), reset_tail, state, bitcount)
+                            self._count_end_bits(rest)
+                            return bytes(output[start:])
+
+            if reset_tail is None:
+                samples_this_byte += processed
+            else:
+                samples_this_byte = reset_tail
+
+            if all_idle:
+                num_samples_all_high += idle_run
+            else:
+                num_samples_all_high = idle_run
+
+        self.state = state
+        self.accum = accum
+        self.bitcount = bitcount
+        self.samples_this_byte = samples_this_byte
+        self.num_samples_all_high = num_samples_all_high
+        self.num_raw_bytes += len(chunk)
+        return bytes(output[start:])
+
+    def _stop(self, num_raw_bytes, reset_tail, state, end_bits):
+        # The frame ended within the last of num_raw_bytes raw bytes fed, which also held end_bits bits
+        # after it.
+        self.done = True
+        self.state = state
+        self.end_bits = end_bits
+        self.accum = self.bitcount = 0
+        self.samples_this_byte = reset_tail or 0
+        self.num_raw_bytes += num_raw_bytes
+
+    def _count_end_bits(self, raw_bytes):
+        table = STREAM_TABLE
+        state = self.state
+        for byte in raw_bytes:
+            state, num_bits, _, _, _, _, all_idle = table[(state << 8) | byte]
+            if all_idle:
+                self.finished = True
+                return
+            self.end_bits += num_bits
+        self.state = state
+
+    def result(self):
+        num_samples = (self.num_raw_bytes * RAW_SAMPLES_PER_BYTE) - self.samples_this_byte
+        if self.done:
+            expected = self.expected
+            return DecodedRx(result=bytes(self.output[:expected - 1]), num_samples=num_samples,
+                    completed=True, checksum=self.output[expected - 1], expected=expected,
+                    end_bits=self.end_bits if self.finished else None)
+
+        output = bytes(self.output)
+        recv_completed = self.completed
+        checksum = None
+        if recv_completed and output:
+            checksum = output[-1]
+            output = output[:-1]
+
+        return DecodedRx(result=output, num_samples=num_samples, completed=recv_completed,
+                checksum=checksum, partial=(self.accum, self.bitcount), expected=self.expected)
+
+def frame_is_valid(frame, checksum):
+    """
+    True if frame (a reply without its checksum) has the length given by its header and the given
+    checksum.
+    """
+    if checksum is None or len(frame) < 4:
+        return False
+    if len(frame) != 4 + (frame[0] * 4):
+        return False
+    return compute_checksum(frame) == checksum
 
 def calculate_recv_skip(samples_so_far):
     " Calculate the amount to skip forward. "
     samples_to_skip = max(0, samples_so_far - RX_SKIP_SAFETY_FACTOR)
     return samples_to_skip // SKIP_LOOP_LENGTH
 
+class DeviceInfo(collections.namedtuple('DeviceInfo', ('address', 'functions', 'function_data', 'name',
+        'license', 'standby_power', 'max_power'))):
+    """
+    The reply to CMD_INFO. Power is in tenths of a milliwatt, according to the patent.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, address, info_bytes):
+        """
+        Return the DeviceInfo in a reply, or None if there was no reply.
+        """
+        if get_command(info_bytes) != CMD_INFO_RESP or len(info_bytes) < 4 + 112:
+            return None
+        info_bytes = info_bytes[4:] # Strip header
+        func, func_data_0, func_data_1, func_data_2, product_name,\
+                product_license =\
+                struct.unpack("<IIII32s60s", info_bytes[:108])
+        max_power, standby_power = struct.unpack(">HH", info_bytes[108:112])
+        #print "Area       :", ord(area_code)
+        #print "Direction? :", ord(connector_dir)
+        return cls(address, func, (func_data_0, func_data_1, func_data_2), swapwords(product_name),
+                swapwords(product_license), standby_power, max_power)
+
+    def supports(self, function):
+        return bool(self.functions & function)
+
+    def format(self):
+        lines = [
+            "Device information (address %s):" % (hex(self.address),),
+            "Functions  : %s" % (', '.join(decode_func_codes(self.functions)),),
+        ]
+        for idx, func_data in enumerate(self.function_data):
+            lines.append("Periph %d   : %s" % (idx + 1, hex(func_data)))
+        lines += [
+            "Name       : %s" % (debug_txt(self.name).decode('ascii'),),
+            "License    : %s" % (debug_txt(self.license).decode('ascii'),),
+            "Power      : %d" % (self.standby_power,),
+            "Power max  : %d" % (self.max_power,),
+        ]
+        return '\n'.join(lines)
+
+class MemInfo(collections.namedtuple('MemInfo', ('max_block', 'min_block', 'root_block', 'fat_block',
+        'fat_size', 'dir_block', 'dir_size', 'icon', 'user_blocks'))):
+    """
+    The reply to CMD_GET_MEMINFO: the layout of a memory card's file system.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, info_bytes):
+        """
+        Return the MemInfo in a reply, or None if there wasn't a valid one.
+        """
+        if get_command(info_bytes) != CMD_XFER_RESP or len(info_bytes) != 4 + 4 + (12 * 2):
+            return None
+        info_bytes = swapwords(info_bytes[4:])
+        fields = struct.unpack("<IHHHHHHHHHHHH", info_bytes)
+        # Then three reserved words
+        return cls(*fields[1:10])
+
+    def format(self):
+        return '\n'.join([
+            "  Max block : %d" % (self.max_block,),
+            "  Min block : %d" % (self.min_block,),
+            "  Inf pos   : %d" % (self.root_block,),
+            "  FAT pos   : %d" % (self.fat_block,),
+            "  FAT size  : %d" % (self.fat_size,),
+            "  Dir pos   : %d" % (self.dir_block,),
+            "  Dir size  : %d" % (self.dir_size,),
+            "  Icon      : %d" % (self.icon,),
+            "  Data size : %d" % (self.user_blocks,),
+        ])
+
+class Condition(collections.namedtuple('Condition', ('function', 'data'))):
+    """
+    The reply to CMD_GET_COND: the function it's for and its condition words, in host byte order.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, info_bytes):
+        if get_command(info_bytes) != CMD_XFER_RESP or len(info_bytes) < 8:
+            return None
+        function, = struct.unpack("<I", info_bytes[4:8])
+        return cls(function, swapwords(info_bytes[8:]))
+
+    def format(self):
+        return "%s: %s" % (', '.join(decode_func_codes(self.function)), debug_hex(self.data))
+
+def parse_flash_block(info_bytes, block, phase):
+    """
+    Return the block data from the reply to CMD_READ, or raise MapleError if it isn't a whole block.
+    """
+    data = info_bytes[12:]
+    data = swapwords(data)
+    if len(data) != 512 or get_command(info_bytes) != CMD_XFER_RESP:
+        raise MapleError("couldn't read block %d phase %d (response %r)" % (block, phase,
+            get_command(info_bytes)))
+
+    return data
+
+def rle_encode(raw):
+    """
+    Run-length encode raw samples as the proxy does: every run of up to 255 RLE_ESCAPE bytes becomes
+    RLE_ESCAPE followed by the length of the run. Other bytes are sent as they are.
+    """
+    return RLE_RUN.sub(lambda match: bytes([RLE_ESCAPE, len(match.group())]), raw)
+
+class RLEExpander(object):
+    """
+    Undo rle_encode on a reply arriving in chunks, which may split an escape from its count.
+    """
+    def __init__(self):
+        self.escape_pending = False
+
+    def expand(self, chunk):
+        output = bytearray()
+        pos = 0
+        if self.escape_pending and chunk:
+            output += b'\xff' * chunk[0]
+            pos = 1
+            self.escape_pending = False
+
+        while True:
+            idx = chunk.find(b'\xff', pos)
+            if idx < 0:
+                output += chunk[pos:]
+                break
+            output += chunk[pos:idx]
+            if idx + 1 == len(chunk):
+                self.escape_pending = True
+                break
+            output += b'\xff' * chunk[idx + 1]
+            pos = idx + 2
+        return bytes(output)
+
+def frame_message(packet, recv_skip):
+    """
+    The serial message asking the proxy to send packet: its length, recv_skip, then the packet itself.
+    """
+    return bytes([len(packet)]) + struct.pack('<H', recv_skip) + packet
+
+def build_packet(command, recipient, data):
+    """
+    Construct a frame: header, data and checksum.
+    """
+    return bytes(Frame().pack(command, recipient, ADDRESS_DC, data).packet())
+
+class ReplyCollector(object):
+    """
+    The passes and retries needed for the replies to a number of frames, however the passes are sent:
+
+        collector = ReplyCollector(len(frames), bus.skip_calibration, allow_repeats, bus.max_attempts)
+        for passes in collector.rounds():
+            if collector.retrying:
+                ...  # Pause, and drop anything left over from the failed attempt
+            collector.received([fetch(frames[idx], recv_skip) for idx, recv_skip in passes])
+        replies = collector.replies
+
+    Each round asks for one more pass of every reply still coming in, which received() stitches on. An
+    attempt ends once every reply has ended or stopped; replies which then fail validation are fetched
+    again from scratch, up to max_attempts attempts in all, after which they're left as they were.
+    valid says which replies passed. Retries and truncated replies are counted in record, if given.
+
+    Until the calibration has learnt from a reply, the later passes of the others would all miss in
+    the same way, so they're held back and fetched one reply at a time.
+    """
+    def __init__(self, num_replies, calibration, allow_repeats, max_attempts, record=None):
+        self.calibration = calibration
+        self.allow_repeats = allow_repeats
+        self.max_attempts = max_attempts if allow_repeats else 1
+        self.record = record
+        self.replies = [b''] * num_replies
+        self.valid = [False] * num_replies
+        self.retrying = False  # Set for the first round of each attempt after the first
+        self.stitchers = {}
+        self.passing = []  # Replies still coming in
+        self.fetching = []  # (index, recv_skip) of those asked for in the current round
+
+    def rounds(self):
+        """
+        Yield a list of (reply index, recv_skip) for each round of passes to fetch.
+        """
+        pending = list(range(len(self.replies)))
+        for attempt in range(self.max_attempts):
+            self.retrying = attempt > 0
+            if self.retrying and self.record is not None:
+                self.record.retries += 1
+            self.stitchers = {idx: ReplyStitcher(self.calibration) for idx in pending}
+            self.passing = pending
+            while self.passing:
+                # Skips are worked out only now, from the calibration as it stands.
+                passes = [(idx, self.stitchers[idx].next_skip() if self.stitchers[idx].num_passes else 0)
+                        for idx in self.passing]
+                if not self.calibration.num_observed:
+                    later = [(idx, recv_skip) for idx, recv_skip in passes if recv_skip]
+                    passes = [(idx, recv_skip) for idx, recv_skip in passes if not recv_skip] + later[:1]
+                self.fetching = passes
+                yield passes
+                self.retrying = False
+
+            invalid = []
+            for idx in pending:
+                stitcher = self.stitchers[idx]
+                if stitcher.missing and self.record is not None:
+                    self.record.truncated += 1
+                self.replies[idx], checksum = stitcher.frame(frame_is_valid)
+                self.valid[idx] = frame_is_valid(self.replies[idx], checksum)
+                if not self.valid[idx]:
+                    invalid.append(idx)
+            pending = invalid
+            if not pending:
+                return
+            # The calibration may have put the passes in the wrong place, so don't trust it again.
+            self.calibration.reset()
+
+    def received(self, rx_responses):
+        """
+        Stitch on the pass fetched for each of the last round's requests: an RxResponse, or None if there
+        was no reply.
+        """
+        stopped = set()
+        for (idx, recv_skip), rx_response in zip(self.fetching, rx_responses):
+            stitcher = self.stitchers[idx]
+            if rx_response is None:
+                stopped.add(idx)
+                continue
+            if not stitcher.add(recv_skip, rx_response):
+                # The pass didn't join on to the previous ones: try again from further back.
+                if not self.allow_repeats or not stitcher.widen():
+                    stopped.add(idx)
+                    continue
+            elif not self.allow_repeats or stitcher.ended or not rx_response.result:
+                # Let the calibration learn from it now, for the passes of the others.
+                stitcher.frame(frame_is_valid)
+                stopped.add(idx)
+        self.passing = [idx for idx in self.passing if idx not in stopped]
+
+    def raise_if_invalid(self):
+        """
+        Raise MapleError unless every reply passed validation.
+        """
+        num_invalid = self.valid.count(False)
+        if num_invalid:
+            raise MapleError("no valid reply to %d of %d frames after %d attempts" % (num_invalid,
+                len(self.valid), self.max_attempts))
+
 class MapleProxy(object):
-    def __init__(self, port=PORT):
-        log("connecting to %s" % (port))
-        self.handle = serial.Serial(port, 57600, timeout = 1)
+    # A maple_metrics.Metrics to record transactions in, if wanted.
+    metrics = None
+    _record = None  # The transaction being recorded
+    # False for proxies which hand whole transactions to something else to run, so can't run single passes.
+    runs_passes = True
+
+    def __init__(self, port=PORT, handle=None, max_attempts=DEFAULT_MAX_ATTEMPTS, retry_delay=0,
+            options=SUPPORTED_OPTIONS, log=log):
+        """
+        Connect to the proxy on the given serial port. Alternatively pass an already-open serial-like
+        handle (anything with read and write), such as a maple_emu.EmulatedProxy.
+
+        Replies which fail validation are retried up to max_attempts times in all, retry_delay seconds
+        apart. options are requested from the proxy if it supports them; self.options holds those it
+        accepted. Progress messages while connecting go to log.
+        """
+        self._init_state(max_attempts, retry_delay)
+        if handle is None:
+            log("connecting to %s" % (port))
+            handle = serial.Serial(port, 57600, timeout = 1)
+        self.handle = handle
 
         total_sleep = 0
         while total_sleep < 5:
-            print("are you there?")
+            log("are you there?")
             self.handle.write(b'\x00\x00\x00') # are-you-there
             result = self.handle.read(1)
-            if result == b'\x01':
+            if result == HANDSHAKE_REPLY:
                 break
             time.sleep(0.5)
             total_sleep += 0.5
         else:
             raise Exception()
 
-        print("maple proxy detected")
+        log("maple proxy detected")
+
+        if options:
+            self._negotiate(options)
+            if self.options & OPTION_RLE:
+                log("using compressed replies")
+
+    def _init_state(self, max_attempts=DEFAULT_MAX_ATTEMPTS, retry_delay=0):
+        """
+        Set up everything but the connection to the proxy. Subclasses which get their frames sent some
+        other way (maple_sched, maple_daemon) call this instead of __init__.
+        """
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1, not %r" % (max_attempts,))
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.options = 0
+        self.forget()
+        # Learns where the proxy's recv_skip really lands, for joining the passes of long replies.
+        self.skip_calibration = SkipCalibration(SKIP_LOOP_LENGTH)
+        # Frames are packed into these rather than into new bytes objects.
+        self.frame = Frame()
+        self.batch_frames = []
+        self.batch_buffer = bytearray()
+
+    def _negotiate(self, options):
+        """
+        Ask the proxy for options. Unless it clearly accepts, options are turned off again at both ends.
+        """
+        # Throw away replies to earlier are-you-theres which arrived late.
+        if hasattr(self.handle, 'reset_input_buffer'):
+            self.handle.reset_input_buffer()
+
+        self.handle.write(frame_message(b'', options))
+        if self.handle.read(1) == OPTIONS_REPLY:
+            accepted = self.handle.read(1)
+            if accepted:
+                self.options = accepted[0] & options
+                return
+
+        # Old firmware, or the reply went missing. An are-you-there turns off any options the proxy did take.
+        self.handle.write(b'\x00\x00\x00')
+        self.handle.read(1)
+        if hasattr(self.handle, 'reset_input_buffer'):
+            self.handle.reset_input_buffer()
     
     def __del__(self):
         if hasattr(self, 'handle'):
             self.handle.close()
     
-    def deviceInfo(self, address, debug_filename=None):
-        # cmd 1 = request device information
-        info_bytes = self.transact(CMD_INFO, address, b'', debug_write_filename=debug_filename, allow_repeats=True)
+    def forget(self, address=None):
+        """
+        Drop cached device and memory information for an address, or for every address.
+        """
+        if address is None:
+            self.device_info = {}
+            self.mem_info = {}
+        else:
+            self.device_info.pop(address, None)
+            self.mem_info.pop(address, None)
+
+    def _command(self, command, address, data, **kwargs):
+        """
+        transact, but forget what we knew about a device which doesn't reply: it may have been unplugged,
+        and may be something else when it comes back.
+        """
+        info_bytes = self.transact(command, address, data, **kwargs)
         if not info_bytes:
-            print("No device found at address:")
-            print(hex(address))
-            return False
+            self.forget(address)
+        return info_bytes
 
-        #print info_bytes, len(info_bytes)
-        print_header(info_bytes[:4])
-        info_bytes = info_bytes[4:] # Strip header
-        print("Device information:")
-        print("raw:", debug_hex(swapwords(info_bytes)), len(info_bytes))
-        func, func_data_0, func_data_1, func_data_2, product_name,\
-                product_license =\
-                struct.unpack("<IIII32s60s", info_bytes[:108])
-        max_power, standby_power = struct.unpack(">HH", info_bytes[108:112])
-        print("Functions  :", ', '.join(decode_func_codes(func)))
-        print("Periph 1   :", hex(func_data_0))
-        print("Periph 2   :", hex(func_data_1))
-        print("Periph 3   :", hex(func_data_2))
-        #print "Area       :", ord(area_code)
-        #print "Direction? :", ord(connector_dir)
-        print("Name       :", debug_txt(swapwords(product_name)))
-        print("License    :", debug_txt(swapwords(product_license)))
-        # These are in tenths of a milliwatt, according to the patent:
-        print("Power      :", standby_power)
-        print("Power max  :", max_power)
-        return True
+    def deviceInfo(self, address, debug_filename=None, refresh=False):
+        """
+        Return a DeviceInfo for the device at address, or None if there isn't one. Cached until the
+        device is reset or stops replying, unless refresh is set.
+        """
+        if address not in self.device_info or refresh or debug_filename:
+            # cmd 1 = request device information
+            info_bytes = self._command(CMD_INFO, address, b'', debug_write_filename=debug_filename,
+                    allow_repeats=True)
+            info = DeviceInfo.parse(address, info_bytes)
+            if info is None:
+                self.forget(address)
+                return None
+            self.device_info[address] = info
+        return self.device_info[address]
 
     def readFlash(self, address, block, phase):
         addr = (0 << 24) | (phase << 16) | block
         cmd = struct.pack("<II", FN_MEMORY_CARD, addr)
-        while True:
-            info_bytes = self.transact(CMD_READ, address, cmd, None, allow_repeats=True)
-            data = info_bytes[12:]
-            data = swapwords(data)
-            if len(data) == 512 and get_command(info_bytes) == CMD_XFER_RESP:
-                break
-
-        return data
+        info_bytes = self._command(CMD_READ, address, cmd, allow_repeats=True, require_valid=True)
+        return parse_flash_block(info_bytes, block, phase)
 
     def getCond(self, address, function):
+        """
+        Return a Condition, or None if there was no valid reply.
+        """
         data = struct.pack("<I", function)
-        info_bytes = self.transact(CMD_GET_COND, address, data)
-        print("getCond:")
-        print_header(info_bytes[:4])
-        print(debug_hex(info_bytes))
-    
+        return Condition.parse(self._command(CMD_GET_COND, address, data))
+
     def writeLCD(self, address, lcddata):
-        assert len(lcddata) == 192
-        data = struct.pack("<II", FN_LCD, 0) + lcddata
-        info_bytes = self.transact(CMD_WRITE, address, data)
-        if info_bytes is None:
-            print("No response to writeLCD")
-        else:
-            print_header(info_bytes[:4])
-    
+        """
+        Returns True if the write was acknowledged. As for the other writes.
+        """
+        return get_command(self._command(CMD_WRITE, address, lcd_payload(lcddata))) == CMD_ACK_RESP
+
     def writeFlash(self, address, block, phase, data):
         data = swapwords(data)
         assert len(data) == 128
         addr = (phase << 16) | block
         data = struct.pack("<II", FN_MEMORY_CARD, addr) + data
-        info_bytes = self.transact(CMD_WRITE, address, data)
-        print(info_bytes)
-        return
-
-        if info_bytes is None:
-            print("No response to writeFlash")
-        else:
-            assert get_command(info_bytes) == CMD_ACK_RESP, get_command(info_bytes)
+        return get_command(self._command(CMD_WRITE, address, data)) == CMD_ACK_RESP
 
     def writeFlashComplete(self, address, block):
         addr = (4 << 16) | block
         data = struct.pack('<II', FN_MEMORY_CARD, addr)
-        info_bytes = self.transact(CMD_WRITE_COMPLETE, address, data)
-        print(info_bytes)
-        return
+        return get_command(self._command(CMD_WRITE_COMPLETE, address, data)) == CMD_ACK_RESP
+
+    def readFlashBlocks(self, address, blocks):
+        """
+        Read several whole blocks, batched if the proxy supports it. Returns a list of their contents, or
+        raises MapleError if any of them couldn't be read.
+        """
+        requests = [(CMD_READ, address, struct.pack("<II", FN_MEMORY_CARD, block)) for block in blocks]
+        replies = self.transact_batch(requests, allow_repeats=True, require_valid=True)
+        return [parse_flash_block(info_bytes, block, 0) for block, info_bytes in zip(blocks, replies)]
+
+    def writeFlashBlock(self, address, block, data, phases=range(4)):
+        """
+        Write the given 128-byte phases of a 512-byte block and complete the write, batched if the proxy
+        supports it. If any frame isn't acknowledged, all of them are sent again, up to max_attempts times
+        in all: writing a phase twice does no harm. Raises MapleError if no attempt was acknowledged and
+        reading the block back shows it wasn't written.
+        """
+        requests = []
+        for phase in phases:
+            addr = (phase << 16) | block
+            requests.append((CMD_WRITE, address, struct.pack("<II", FN_MEMORY_CARD, addr) +
+                swapwords(data[phase * 128 : (phase + 1) * 128])))
+        requests.append((CMD_WRITE_COMPLETE, address, struct.pack('<II', FN_MEMORY_CARD, (4 << 16) | block)))
+
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self.retry_delay)
+            responses = [get_command(info_bytes) for info_bytes in self.transact_batch(requests)]
+            bad_responses = [response for response in responses if response != CMD_ACK_RESP]
+            if not bad_responses:
+                return
+
+        # The writes may have worked, with only the acknowledgements lost.
+        try:
+            written = self.readFlash(address, block, 0)
+        except MapleError:
+            written = None
+        if written is not None and all(written[phase * 128 : (phase + 1) * 128] ==
+                data[phase * 128 : (phase + 1) * 128] for phase in phases):
+            return
+        raise MapleError("couldn't write block %d (response %r)" % (block, bad_responses[0]))
 
     def resetDevice(self, address):
-        info_bytes = self.transact(CMD_RESET, address, b'')
-        print_header(info_bytes[:4])
-        print(debug_hex(info_bytes))
-    
-    def getMemInfo(self, address):
-        partition = 0x0
-        data = struct.pack("<II", FN_MEMORY_CARD, partition << 24)
-        info_bytes = self.transact(CMD_GET_MEMINFO, address, data, allow_repeats=True)
-        print_header(info_bytes[:4])
-        return
-        
-        info_bytes = info_bytes[4:-1]
-        assert len(info_bytes) == 4 + (12 * 2)
-        info_bytes = swapwords(info_bytes)
-
-        func_code, maxblk, minblk, infpos, fatpos, fatsz, dirpos, dirsz, icon, datasz,  \
-            res1, res2, res3 = struct.unpack("<IHHHHHHHHHHHH", info_bytes)
-        print("  Max block :", maxblk)
-        print("  Min block :", minblk)
-        print("  Inf pos   :", infpos)
-        print("  FAT pos   :", fatpos)
-        print("  FAT size  :", fatsz)
-        print("  Dir pos   :", dirpos)
-        print("  Dir size  :", dirsz)
-        print("  Icon      :", icon)
-        print("  Data size :", datasz)
+        self.forget(address)
+        return get_command(self._command(CMD_RESET, address, b'')) == CMD_ACK_RESP
+
+    def getMemInfo(self, address, refresh=False):
+        """
+        Return the MemInfo of the memory card at address, or None if there wasn't a valid reply. Cached
+        like deviceInfo.
+        """
+        if address not in self.mem_info or refresh:
+            partition = 0x0
+            data = struct.pack("<II", FN_MEMORY_CARD, partition << 24)
+            info = MemInfo.parse(self._command(CMD_GET_MEMINFO, address, data, allow_repeats=True))
+            if info is None:
+                return None
+            self.mem_info[address] = info
+        return self.mem_info[address]
 
     def readController(self, address):
         data = struct.pack("<I", FN_CONTROLLER)
-        info_bytes = self.transact(CMD_GET_COND, address, data)
+        info_bytes = self._command(CMD_GET_COND, address, data)
         return info_bytes
-        #print debug_hex(info_bytes)
-
-    def transact(self, command, recipient, data, debug_write_filename=None, allow_repeats=False):
-        # Construct a frame header.
-        sender = ADDRESS_DC
-        assert len(data) < 256, data
-        header = (command << 24) | (recipient << 16) | (sender << 8) | (len(data) // 4)
-        packet = struct.pack("<I", header) + data
-        packet += bytes([self.compute_checksum(packet)])
-
-        #print ('out', debug_hex(packet))
-        # Write the frame, wait for response.
-        completed = False
-        entire_message = b''
-        samples_so_far = 0
 
-        while True:
-            recv_skip = calculate_recv_skip(samples_so_far)
-            rx_response = self._transact_multiple(packet, recv_skip, num_tries=3 if allow_repeats else 1)
-            entire_message = align_messages(entire_message, rx_response.result)
-            if not allow_repeats or rx_response.completed:
+    def transact(self, command, recipient, data, debug_write_filename=None, allow_repeats=False,
+            require_valid=False):
+        """
+        Send a frame and return the reply, without its checksum.
+
+        If allow_repeats is set, long replies are fetched in several passes, and the reply is checked
+        against its header word count and checksum. A bad reply is retried, up to max_attempts times in
+        all, after which the last reply is returned as-is, or MapleError raised if require_valid is set.
+        """
+        frame = self.frame.pack(command, recipient, ADDRESS_DC, data)
+        return self._instrumented(command, self._transact, frame, debug_write_filename, allow_repeats,
+                require_valid)
+
+    def _instrumented(self, label, func, *args):
+        """
+        Return func(*args), recorded under label if metrics are enabled. See maple_metrics.
+        """
+        if self.metrics is None:
+            return func(*args)
+
+        self._record = self.metrics.start(label)
+        try:
+            return func(*args)
+        finally:
+            self.metrics.finish(self._record)
+            self._record = None
+
+    def _transact(self, frame, debug_write_filename, allow_repeats, require_valid):
+        collector = self._collect(1, allow_repeats, lambda passes: [self._transact_multiple(frame, recv_skip,
+                debug_write_filename) for _, recv_skip in passes])
+        if require_valid:
+            collector.raise_if_invalid()
+        return collector.replies[0]
+
+    def _collect(self, num_replies, allow_repeats, fetch):
+        """
+        Run a ReplyCollector, with fetch(passes) returning the RxResponse of each (index, recv_skip).
+        """
+        collector = ReplyCollector(num_replies, self.skip_calibration, allow_repeats, self.max_attempts,
+                self._record)
+        for passes in collector.rounds():
+            if collector.retrying:
+                self._before_retry()
+            collector.received(fetch(passes))
+        return collector
+
+    def _before_retry(self):
+        time.sleep(self.retry_delay)
+        self._discard_input()
+
+    def _discard_input(self):
+        # Anything still arriving belongs to the failed attempt.
+        if hasattr(self.handle, 'reset_input_buffer'):
+            self.handle.reset_input_buffer()
+
+    def _transact_multiple(self, frame, recv_skip, debug_write_filename=None):
+        """
+        Send a Frame to the proxy and decode one pass of the reply, or return None if there wasn't one.
+        """
+        self._write(frame.message(recv_skip))
+        return self._read_reply(recv_skip == 0, debug_write_filename)
+
+    def _write(self, message):
+        record = self._record
+        if record is None:
+            self.handle.write(message)
+        else:
+            started = time.perf_counter()
+            self.handle.write(message)
+            record.write_seconds += time.perf_counter() - started
+            record.passes += 1
+
+    def _read_reply(self, header, debug_write_filename=None):
+        """
+        Read and decode one pass of a reply. header is set if the pass starts at the frame's header.
+        """
+        record = self._record
+        if record is not None:
+            started = time.perf_counter()
+        num_bytes = self.handle.read(2)
+        if record is not None:
+            record.first_byte_seconds += time.perf_counter() - started
+        if len(num_bytes) < 2:
+            return None
+
+        num_bytes = struct.unpack(">H", num_bytes)[0]
+        # Decode while the rest of the response is still arriving.
+        decoder = StreamDecoder(header)
+        expander = RLEExpander() if self.options & OPTION_RLE else None
+        raw_chunks = []
+        while num_bytes > 0:
+            chunk = self.handle.read(min(num_bytes, STREAM_CHUNK_SIZE))
+            if not chunk:
                 break
-            samples_so_far += rx_response.num_samples
-
-        return entire_message
-
-    def _transact_multiple(self, packet, recv_skip, num_tries, debug_write_filename=None):
-        prev_response = None
-        response = None
-        for retry in range(num_tries):
-            self.handle.write(bytes([len(packet)]))
-            self.handle.write(struct.pack('<H', recv_skip))  # recv skip
-            self.handle.write(packet)
-            num_bytes = self.handle.read(2)
-            if num_bytes:
-                num_bytes = struct.unpack(">H", num_bytes)[0]
-                raw_response = self.handle.read(num_bytes)
-                if debug_write_filename:
-                    with open(debug_write_filename, 'wb') as h:
-                        h.write(raw_response)
-
-                response = debittify(raw_response)
-                if prev_response and prev_response.result == response.result:
+            num_bytes -= len(chunk)
+            if record is not None:
+                record.raw_bytes += len(chunk)
+            if decoder.finished and not debug_write_filename:
+                # The frame is all in; the rest is only read to keep in step with the proxy.
+                continue
+            if record is not None:
+                started = time.perf_counter()
+            if expander is not None:
+                chunk = expander.expand(chunk)
+            decoder.feed(chunk)
+            if record is not None:
+                record.decode_seconds += time.perf_counter() - started
+            if debug_write_filename:
+                raw_chunks.append(chunk)
+
+        if debug_write_filename:
+            with open(debug_write_filename, 'wb') as h:
+                h.write(b''.join(raw_chunks))
+
+        rx_response = decoder.result()
+        if record is not None:
+            record.samples += rx_response.num_samples
+        return rx_response
+
+    def transact_batch(self, requests, allow_repeats=False, require_valid=False):
+        """
+        Send a (command, recipient, data) frame for each of requests and return a list of the replies, as
+        transact would; with require_valid, MapleError is raised if any of them is bad. If the proxy
+        supports batches, all the frames go to it in one serial message (or as few as fit its buffer),
+        and later passes of long replies are batched the same way. Otherwise the frames are sent one at
+        a time.
+        """
+        if not self.options & OPTION_BATCH:
+            return [self.transact(command, recipient, data, allow_repeats=allow_repeats,
+                    require_valid=require_valid) for command, recipient, data in requests]
+
+        while len(self.batch_frames) < len(requests):
+            self.batch_frames.append(Frame())
+        frames = [frame.pack(command, recipient, ADDRESS_DC, data)
+                for frame, (command, recipient, data) in zip(self.batch_frames, requests)]
+        return self._instrumented(BATCH_LABEL, self._transact_batches, frames, allow_repeats, require_valid)
+
+    def _transact_batches(self, frames, allow_repeats, require_valid):
+        collector = self._collect(len(frames), allow_repeats, lambda passes: self._transact_batch(
+                [(frames[idx], recv_skip) for idx, recv_skip in passes]))
+        if require_valid:
+            collector.raise_if_invalid()
+        return collector.replies
+
+    def _transact_batch(self, frames):
+        """
+        Send (Frame, recv_skip) pairs to the proxy in batches, and decode one pass of each reply, or None
+        for replies which didn't arrive.
+        """
+        rx_responses = []
+        buffer = self.batch_buffer
+        while frames:
+            num_frames = 0
+            size = 0
+            for frame, _ in frames:
+                if num_frames and size + frame.message_size() > BATCH_BUFFER_SIZE:
+                    break
+                num_frames += 1
+                size += frame.message_size()
+
+            batch, frames = frames[:num_frames], frames[num_frames:]
+            del buffer[:]
+            buffer += frame_message(b'', BATCH_MARKER | num_frames)
+            for frame, recv_skip in batch:
+                buffer += frame.message(recv_skip)
+
+            self._write(buffer)
+            batch_responses = []
+            for _, recv_skip in batch:
+                rx_response = self._read_reply(recv_skip == 0)
+                if rx_response is None:
+                    # The proxy has stopped responding, so the rest of this batch won't come either.
                     break
+                batch_responses.append(rx_response)
+            rx_responses.extend(batch_responses + [None] * (num_frames - len(batch_responses)))
+        return rx_responses
 
-        return response
-                
     def compute_checksum(self, data):
-        checksum = 0
-        for datum in data:
-            checksum ^= datum
-        return checksum
+        return compute_checksum(data)
+
+# A port of this form names a maple_daemon socket rather than a serial port.
+DAEMON_PREFIX = 'unix:'
+REPLAY_PREFIX = 'replay:'
+CAPTURE_ENV = 'MAPLE_CAPTURE'
+
+def connect(port=PORT, **kwargs):
+    """
+    Return a MapleProxy for the given serial port, or a client of a running maple_daemon if port is
+    'unix:' followed by the daemon's socket path, or a MapleProxy replaying a maple_capture file if port
+    is 'replay:' followed by its filename. If MAPLE_CAPTURE is set in the environment, the session with
+    a serial port is captured to the file it names.
+    """
+    if port.startswith(DAEMON_PREFIX):
+        import maple_daemon
+        return maple_daemon.DaemonClient(port[len(DAEMON_PREFIX):])
+    if port.startswith(REPLAY_PREFIX):
+        import maple_capture
+        return MapleProxy(handle=maple_capture.ReplayHandle(port[len(REPLAY_PREFIX):]), **kwargs)
+    if os.environ.get(CAPTURE_ENV):
+        import maple_capture
+        kwargs.get('log', log)("connecting to %s" % (port))
+        handle = serial.Serial(port, 57600, timeout = 1)
+        return MapleProxy(handle=maple_capture.CaptureHandle(handle, os.environ[CAPTURE_ENV]), **kwargs)
+    return MapleProxy(port, **kwargs)
 
 def debug_dump(filename):
     with open(filename, 'rb') as h:
         raw_data = h.read()
 
     result = debittify(raw_data)
-    print("raw:", debug_hex(swapwords(result)), len(result))
+    print("raw:", debug_hex(swapwords(result.result)), len(result.result), describe_rx(result))
 
 def test():
     parser = argparse.ArgumentParser()
@@ -504,18 +1302,17 @@ def test():
     args = parser.parse_args()
 
     if args.port:
-        bus = MapleProxy(args.port)
+        bus = connect(args.port)
 
         # Nothing will work before you do a deviceInfo on the controller.
         # I guess this forces the controller to enumerate its devices.
-        debug_filename = '%s-controller' % (args.debug_prefix,) if args.debug_prefix else None
-        found_controller = bus.deviceInfo(ADDRESS_CONTROLLER, debug_filename=debug_filename)
-        if not found_controller:
-            print("Couldn't find controller.")
-            #return
-
-        debug_filename = '%s-vmu' % (args.debug_prefix,) if args.debug_prefix else None
-        found_vmu = bus.deviceInfo(ADDRESS_PERIPH1, debug_filename=debug_filename)
+        for address, name in ((ADDRESS_CONTROLLER, 'controller'), (ADDRESS_PERIPH1, 'vmu')):
+            debug_filename = '%s-%s' % (args.debug_prefix, name) if args.debug_prefix else None
+            info = bus.deviceInfo(address, debug_filename=debug_filename)
+            if info is None:
+                print("No device found at address:", hex(address))
+            else:
+                print(info.format())
     else:
         debug_dump(args.debug_prefix + '-controller')
 
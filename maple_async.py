@@ -0,0 +1,321 @@
+"""
+asyncio version of MapleProxy.
+
+AsyncMapleProxy drives the proxy with non-blocking serial I/O from an event loop, so the bus can be
+used alongside other I/O without a thread per device. Only one transaction is on the wire at a time.
+If a transaction is cancelled or times out part-way through, the remainder of its reply is drained
+before the next frame is sent, so the proxy's framing is never left out of step.
+
+    bus = await AsyncMapleProxy.connect(port)
+    await bus.deviceInfo(maple.ADDRESS_CONTROLLER)
+    state = await bus.readController(maple.ADDRESS_CONTROLLER)
+"""
+import os
+import struct
+import asyncio
+
+import serial
+
+import maple
+
+# Seconds to wait for the start of a reply, or between parts of one, before giving up on it. The same
+# as the timeout MapleProxy gives pyserial.
+READ_TIMEOUT = 1
+
+# _owed when a frame has been sent but its reply length hasn't been read yet.
+LENGTH_PENDING = -1
+
+class SerialStream(object):
+    """
+    Non-blocking reads and writes on a file descriptor, such as that of a serial port or pty, using the
+    running event loop.
+    """
+    def __init__(self, fd, owner=None):
+        self.fd = fd
+        self.owner = owner  # Closed along with the stream, e.g. the serial.Serial owning fd.
+        self.loop = asyncio.get_running_loop()
+        self.buffer = bytearray()
+        self.readable = asyncio.Event()
+        os.set_blocking(fd, False)
+        self.loop.add_reader(fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            # e.g. the other end of a pty went away.
+            self.loop.remove_reader(self.fd)
+            return
+        self.buffer.extend(data)
+        self.readable.set()
+
+    async def wait_for_bytes(self, num_bytes, timeout):
+        """
+        Wait until at least num_bytes are buffered. Raises asyncio.TimeoutError.
+        """
+        deadline = self.loop.time() + timeout
+        while len(self.buffer) < num_bytes:
+            self.readable.clear()
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            await asyncio.wait_for(self.readable.wait(), remaining)
+
+    def take(self, num_bytes):
+        data = bytes(self.buffer[:num_bytes])
+        del self.buffer[:num_bytes]
+        return data
+
+    async def write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                written = os.write(self.fd, view)
+            except BlockingIOError:
+                writable = self.loop.create_future()
+                self.loop.add_writer(self.fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(self.fd)
+            else:
+                view = view[written:]
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        if self.owner is not None:
+            self.owner.close()
+
+class AsyncMapleProxy(object):
+    # A maple_metrics.Metrics to record transactions in, if wanted, as for MapleProxy.
+    metrics = None
+    _record = None  # The transaction being recorded
+
+    def __init__(self, stream, max_attempts=maple.DEFAULT_MAX_ATTEMPTS, retry_delay=0,
+            read_timeout=READ_TIMEOUT, options=maple.OPTION_RLE):
+        """
+        Use AsyncMapleProxy.connect() rather than constructing one of these directly. max_attempts,
+        retry_delay and options are as for MapleProxy, except that batches aren't supported.
+        """
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1, not %r" % (max_attempts,))
+        self.stream = stream
+        self.wanted_options = options
+        self.options = 0
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.read_timeout = read_timeout
+        self.lock = asyncio.Lock()
+        self.skip_calibration = maple.SkipCalibration(maple.SKIP_LOOP_LENGTH)
+        # Reply bytes still to come from the proxy for a frame we've sent: None if nothing is owed.
+        self._owed = None
+
+    @classmethod
+    async def connect(cls, port=maple.PORT, **kwargs):
+        maple.log("connecting to %s" % (port))
+        handle = serial.Serial(port, 57600, timeout=0)
+        proxy = cls(SerialStream(handle.fileno(), owner=handle), **kwargs)
+        try:
+            await proxy._handshake()
+        except Exception:
+            proxy.close()
+            raise
+        return proxy
+
+    def close(self):
+        self.stream.close()
+
+    async def _handshake(self):
+        total_sleep = 0
+        while total_sleep < 5:
+            await self.stream.write(b'\x00\x00\x00') # are-you-there
+            try:
+                await self.stream.wait_for_bytes(1, 0.5)
+            except asyncio.TimeoutError:
+                total_sleep += 0.5
+                continue
+            if self.stream.take(1) == maple.HANDSHAKE_REPLY:
+                break
+        else:
+            raise maple.MapleError("no maple proxy found")
+
+        if self.wanted_options:
+            await self._negotiate()
+
+    async def _negotiate(self):
+        # As MapleProxy._negotiate: drop late handshake replies, and turn options off again at both ends
+        # unless the proxy clearly accepts them.
+        self.stream.buffer.clear()
+        await self.stream.write(b'\x00' + struct.pack('<H', self.wanted_options))
+        try:
+            await self.stream.wait_for_bytes(1, self.read_timeout)
+            if self.stream.take(1) == maple.OPTIONS_REPLY:
+                await self.stream.wait_for_bytes(1, self.read_timeout)
+                self.options = self.stream.take(1)[0] & self.wanted_options
+                return
+        except asyncio.TimeoutError:
+            pass
+
+        await self.stream.write(b'\x00\x00\x00')
+        try:
+            await self.stream.wait_for_bytes(1, self.read_timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.stream.buffer.clear()
+
+    async def transact(self, command, recipient, data, allow_repeats=False, timeout=None,
+            require_valid=False):
+        """
+        As MapleProxy.transact. If timeout is given and the whole transaction takes longer, it is
+        abandoned and asyncio.TimeoutError raised; cancellation is likewise safe.
+        """
+        packet = maple.build_packet(command, recipient, data)
+        async with self.lock:
+            if self.metrics is None:
+                return await asyncio.wait_for(self._transact(packet, allow_repeats, require_valid), timeout)
+
+            self._record = self.metrics.start(command)
+            try:
+                return await asyncio.wait_for(self._transact(packet, allow_repeats, require_valid), timeout)
+            finally:
+                self.metrics.finish(self._record)
+                self._record = None
+
+    async def _transact(self, packet, allow_repeats, require_valid):
+        collector = maple.ReplyCollector(1, self.skip_calibration, allow_repeats, self.max_attempts,
+                self._record)
+        for passes in collector.rounds():
+            if collector.retrying:
+                await self._before_retry()
+            collector.received([await self._transfer(packet, recv_skip) for _, recv_skip in passes])
+        if require_valid:
+            collector.raise_if_invalid()
+        return collector.replies[0]
+
+    async def _before_retry(self):
+        await asyncio.sleep(self.retry_delay)
+        # Anything still arriving belongs to the failed attempt.
+        if self._owed is not None:
+            await self._drain()
+        self.stream.buffer.clear()
+
+    async def _write_frame(self, frame):
+        # Once started, a frame is always written in full, even if we're cancelled: the proxy would
+        # otherwise take the start of the next frame as the rest of this one.
+        self._owed = LENGTH_PENDING
+        await asyncio.shield(asyncio.ensure_future(self.stream.write(frame)))
+
+    async def _read_length(self):
+        try:
+            await self.stream.wait_for_bytes(2, self.read_timeout)
+        except asyncio.TimeoutError:
+            # Nothing responded.
+            self._owed = None
+            raise
+        self._owed = struct.unpack(">H", self.stream.take(2))[0]
+
+    async def _read_chunk(self):
+        """
+        Return the next part of the owed reply as soon as any of it is available.
+        """
+        try:
+            await self.stream.wait_for_bytes(1, self.read_timeout)
+        except asyncio.TimeoutError:
+            # The rest of the reply has been lost.
+            self._owed = None
+            raise
+        chunk = self.stream.take(self._owed)
+        self._owed -= len(chunk)
+        return chunk
+
+    async def _drain(self):
+        """
+        Discard whatever is left of the reply to an abandoned transaction.
+        """
+        try:
+            if self._owed == LENGTH_PENDING:
+                await self._read_length()
+            while self._owed:
+                await self._read_chunk()
+        except asyncio.TimeoutError:
+            pass
+        self._owed = None
+
+    async def _transfer(self, packet, recv_skip):
+        """
+        Send a packet and decode one pass of the reply, or return None if there wasn't one.
+        """
+        if self._owed is not None:
+            await self._drain()
+
+        await self._write_frame(bytes([len(packet)]) + struct.pack('<H', recv_skip) + packet)
+        record = self._record
+        if record is not None:
+            record.passes += 1
+        try:
+            await self._read_length()
+        except asyncio.TimeoutError:
+            return None
+
+        decoder = maple.StreamDecoder(recv_skip == 0)
+        expander = maple.RLEExpander() if self.options & maple.OPTION_RLE else None
+        while self._owed:
+            try:
+                chunk = await self._read_chunk()
+                if record is not None:
+                    record.raw_bytes += len(chunk)
+                if not decoder.finished:
+                    decoder.feed(chunk if expander is None else expander.expand(chunk))
+            except asyncio.TimeoutError:
+                break
+        self._owed = None
+        rx_response = decoder.result()
+        if record is not None:
+            record.samples += rx_response.num_samples
+        return rx_response
+
+    async def deviceInfo(self, address, timeout=None):
+        info_bytes = await self.transact(maple.CMD_INFO, address, b'', allow_repeats=True, timeout=timeout)
+        return maple.DeviceInfo.parse(address, info_bytes)
+
+    async def getMemInfo(self, address, timeout=None):
+        data = struct.pack("<II", maple.FN_MEMORY_CARD, 0)
+        info_bytes = await self.transact(maple.CMD_GET_MEMINFO, address, data, allow_repeats=True,
+                timeout=timeout)
+        return maple.MemInfo.parse(info_bytes)
+
+    async def getCond(self, address, function, timeout=None):
+        data = struct.pack("<I", function)
+        return maple.Condition.parse(await self.transact(maple.CMD_GET_COND, address, data, timeout=timeout))
+
+    async def readFlash(self, address, block, phase, timeout=None):
+        addr = (0 << 24) | (phase << 16) | block
+        cmd = struct.pack("<II", maple.FN_MEMORY_CARD, addr)
+        info_bytes = await self.transact(maple.CMD_READ, address, cmd, allow_repeats=True, timeout=timeout,
+                require_valid=True)
+        return maple.parse_flash_block(info_bytes, block, phase)
+
+    async def writeFlash(self, address, block, phase, data, timeout=None):
+        data = maple.swapwords(data)
+        assert len(data) == 128
+        addr = (phase << 16) | block
+        data = struct.pack("<II", maple.FN_MEMORY_CARD, addr) + data
+        info_bytes = await self.transact(maple.CMD_WRITE, address, data, timeout=timeout)
+        return maple.get_command(info_bytes) == maple.CMD_ACK_RESP
+
+    async def writeFlashComplete(self, address, block, timeout=None):
+        addr = (4 << 16) | block
+        data = struct.pack('<II', maple.FN_MEMORY_CARD, addr)
+        info_bytes = await self.transact(maple.CMD_WRITE_COMPLETE, address, data, timeout=timeout)
+        return maple.get_command(info_bytes) == maple.CMD_ACK_RESP
+
+    async def writeLCD(self, address, lcddata, timeout=None):
+        data = maple.lcd_payload(lcddata)
+        info_bytes = await self.transact(maple.CMD_WRITE, address, data, timeout=timeout)
+        return maple.get_command(info_bytes) == maple.CMD_ACK_RESP
+
+    async def readController(self, address, timeout=None):
+        data = struct.pack("<I", maple.FN_CONTROLLER)
+        return await self.transact(maple.CMD_GET_COND, address, data, timeout=timeout)
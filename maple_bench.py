@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the decode, transact and whole-card paths.
+
+Decoding is measured against recorded raw captures (e.g. from debug_write_filename) if any are given,
+otherwise against captures synthesised by maple_emu. Everything else runs against an emulated proxy,
+optionally throttled to a real serial link's speed with --baud.
+
+Results are written as JSON, and can be compared against a previous run with --compare.
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import contextlib
+
+import maple
+import maple_emu
+import vmu_dump
+import vmu_flash
+
+# A result this much worse than the baseline counts as a regression.
+REGRESSION_THRESHOLD = 0.10
+
+# For each result, whether a larger number is better.
+HIGHER_IS_BETTER = ('_per_second',)
+
+def synthesised_captures():
+    """
+    Raw captures for a 512-byte block read reply (two passes) and a controller condition reply, each
+    with whether it starts at the frame's header.
+    """
+    block_frame = maple_emu.build_frame(maple.CMD_XFER_RESP, maple.ADDRESS_PERIPH1, os.urandom(520))
+    cond_frame = maple_emu.build_frame(maple.CMD_XFER_RESP, maple.ADDRESS_CONTROLLER, os.urandom(12))
+    first_pass = maple_emu.raw_reply(block_frame, 0)
+    decoded = maple.debittify(first_pass)
+    second_pass = maple_emu.raw_reply(block_frame, maple.calculate_recv_skip(decoded.num_samples))
+    return [(first_pass, True), (second_pass, False), (maple_emu.raw_reply(cond_frame, 0), True)]
+
+def time_per_call(func, *args):
+    """
+    Best-of-three seconds per call.
+    """
+    timer = timeit.Timer(lambda: func(*args))
+    number, _ = timer.autorange()
+    return min(timer.repeat(3, number)) / number
+
+def bench_decode(captures):
+    results = {}
+    num_samples = sum(len(capture) for capture, _ in captures) * maple.RAW_SAMPLES_PER_BYTE
+
+    def run_debittify():
+        for capture, header in captures:
+            maple.debittify(capture, header)
+
+    def run_stream():
+        for capture, header in captures:
+            maple.StreamDecoder(header).feed(capture)
+
+    def run_numpy():
+        for capture, header in captures:
+            maple_numpy.debittify(capture, header)
+
+    results['debittify_samples_per_second'] = num_samples / time_per_call(run_debittify)
+    results['stream_decoder_samples_per_second'] = num_samples / time_per_call(run_stream)
+
+    try:
+        import maple_numpy
+    except ImportError:
+        pass
+    else:
+        results['numpy_samples_per_second'] = num_samples / time_per_call(run_numpy)
+
+    return results
+
+def bench_codec():
+    block = os.urandom(512)
+    packet = os.urandom(4 + 8 + 128)
+    frame = maple.Frame()
+    return {
+        'swapwords_512_seconds': time_per_call(maple.swapwords, block),
+        'compute_checksum_140_seconds': time_per_call(maple.MapleProxy.compute_checksum, None, packet),
+        'frame_pack_140_seconds': time_per_call(lambda: frame.pack(maple.CMD_WRITE, maple.ADDRESS_PERIPH1,
+            maple.ADDRESS_DC, packet[4:]).message(0)),
+    }
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+def emulated_bus(baud=None, image=None):
+    proxy = maple_emu.EmulatedProxy(maple_emu.default_devices(image), baud=baud)
+    with quiet():
+        bus = maple.MapleProxy(handle=proxy)
+    return proxy, bus
+
+def bench_round_trips(baud):
+    """
+    Serial round trips made, and bytes sent back by the proxy, for one call of each transaction type.
+    """
+    proxy, bus = emulated_bus(baud)
+    calls = {
+        'info': lambda: bus.deviceInfo(maple.ADDRESS_PERIPH1),
+        'get_cond': lambda: bus.readController(maple.ADDRESS_CONTROLLER),
+        'meminfo': lambda: bus.getMemInfo(maple.ADDRESS_PERIPH1),
+        'read_flash': lambda: bus.readFlash(maple.ADDRESS_PERIPH1, 0, 0),
+        'write_flash': lambda: bus.writeFlash(maple.ADDRESS_PERIPH1, 0, 0, bytes(vmu_flash.WRITE_SIZE)),
+        'write_lcd': lambda: bus.writeLCD(maple.ADDRESS_PERIPH1, bytes(maple_emu.LCD_SIZE)),
+        'write_flash_block': lambda: bus.writeFlashBlock(maple.ADDRESS_PERIPH1, 0, bytes(vmu_flash.BLOCK_SIZE)),
+        'read_flash_blocks_8': lambda: bus.readFlashBlocks(maple.ADDRESS_PERIPH1, range(8)),
+    }
+
+    results = {}
+    for name, call in calls.items():
+        round_trips_before = proxy.num_round_trips
+        bytes_before = proxy.bytes_to_host
+        with quiet():
+            call()
+        results['round_trips_%s' % (name,)] = proxy.num_round_trips - round_trips_before
+        results['bytes_to_host_%s' % (name,)] = proxy.bytes_to_host - bytes_before
+    return results
+
+def bench_end_to_end(baud):
+    results = {}
+    image = os.urandom(maple_emu.NUM_BLOCKS * maple_emu.BLOCK_SIZE)
+
+    proxy, bus = emulated_bus(baud, image)
+    start = time.perf_counter()
+    with quiet():
+        dumped = b''.join(vmu_dump.read_vmu(None, bus=bus))
+    results['read_vmu_seconds'] = time.perf_counter() - start
+    assert dumped == image
+
+    proxy, bus = emulated_bus(baud, image)
+    start = time.perf_counter()
+    with quiet():
+        dumped = b''.join(vmu_dump.read_vmu(None, bus=bus, depth=vmu_dump.DEFAULT_PIPELINE_DEPTH))
+    results['read_vmu_pipelined_seconds'] = time.perf_counter() - start
+    assert dumped == image
+
+    proxy, bus = emulated_bus(baud)
+    fs_image = vmu_flash.construct_fs_image('bench.bin', image)
+    start = time.perf_counter()
+    with quiet():
+        vmu_flash.write_vmu(fs_image, None, bus=bus)
+    results['write_vmu_seconds'] = time.perf_counter() - start
+    assert bytes(proxy.vmu.flash) == image
+
+    proxy, bus = emulated_bus(baud)
+    lcd = maple.load_image(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'astroboy.txt'))
+    start = time.perf_counter()
+    with quiet():
+        bus.writeLCD(maple.ADDRESS_PERIPH1, lcd)
+    results['write_lcd_seconds'] = time.perf_counter() - start
+
+    return results
+
+def compare(results, baseline):
+    """
+    Print the change for each result present in both runs and return the names of any regressions.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline or not baseline[name]:
+            continue
+        ratio = results[name] / baseline[name]
+        higher_is_better = name.endswith(HIGHER_IS_BETTER)
+        worse = ratio < 1 - REGRESSION_THRESHOLD if higher_is_better else ratio > 1 + REGRESSION_THRESHOLD
+        print("%-40s %12.6g %12.6g %7.2fx%s" % (name, baseline[name], results[name], ratio,
+            '  REGRESSION' if worse else ''))
+        if worse:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('captures', nargs='*', help='recorded raw captures to decode')
+    parser.add_argument('--no-header', action='store_true',
+            help="recorded captures are later passes, which don't start at the frame header")
+    parser.add_argument('-o', '--output', default=None, help='write JSON results here')
+    parser.add_argument('-c', '--compare', default=None, help='JSON results of a previous run')
+    parser.add_argument('--baud', type=int, default=None, help='throttle the emulated link to this rate')
+    parser.add_argument('--skip-end-to-end', action='store_true')
+    args = parser.parse_args()
+
+    if args.captures:
+        captures = []
+        for filename in args.captures:
+            with open(filename, 'rb') as h:
+                captures.append((h.read(), not args.no_header))
+    else:
+        captures = synthesised_captures()
+
+    results = {}
+    results.update(bench_decode(captures))
+    results.update(bench_codec())
+    results.update(bench_round_trips(args.baud))
+    if not args.skip_end_to_end:
+        results.update(bench_end_to_end(args.baud))
+
+    report = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'baud': args.baud,
+        'captures': args.captures,
+        'results': results,
+    }
+
+    for name in sorted(results):
+        print("%-40s %12.6g" % (name, results[name]))
+
+    if args.output:
+        with open(args.output, 'w') as h:
+            json.dump(report, h, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as h:
+            baseline = json.load(h)['results']
+        print()
+        if compare(results, baseline):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
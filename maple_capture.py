@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+Record a whole session with the proxy, and replay it later without the hardware.
+
+CaptureHandle wraps the serial port and logs every write and read, with timestamps. ReplayHandle plays
+a capture back as if it were the serial port, at full speed, so that the decode, retry and stitching
+logic can be profiled and regression-tested against real traces. Both work at the byte level, so the
+handshake, options, batches and compressed replies are all captured exactly.
+
+Set MAPLE_CAPTURE to a filename to capture any tool's session, and use replay:<filename> as its port
+to replay it (see maple.connect):
+
+    MAPLE_CAPTURE=dump.cap python3 vmu_dump.py -p /dev/ttyUSB0 dump.bin
+    python3 vmu_dump.py -p replay:dump.cap dump-again.bin
+    python3 maple_capture.py list dump.cap
+"""
+import sys
+import time
+import struct
+import argparse
+
+import maple
+
+MAGIC = b'MAPLECAP\x01'
+EVENT = struct.Struct('<cdI')
+EVENT_WRITE = b'W'
+EVENT_READ = b'R'  # Zero length if the read timed out
+
+class CaptureHandle(object):
+    """
+    Serial-like wrapper which logs all traffic through handle to filename.
+    """
+    def __init__(self, handle, filename):
+        self.handle = handle
+        self.capture = open(filename, 'wb')
+        self.capture.write(MAGIC)
+        self.started = time.monotonic()
+
+    def _log(self, kind, data):
+        self.capture.write(EVENT.pack(kind, time.monotonic() - self.started, len(data)))
+        self.capture.write(data)
+
+    def write(self, data):
+        self._log(EVENT_WRITE, bytes(data))
+        return self.handle.write(data)
+
+    def read(self, size=1):
+        data = self.handle.read(size)
+        self._log(EVENT_READ, data)
+        return data
+
+    def reset_input_buffer(self):
+        # Bytes thrown away here were never read, so aren't in the capture either.
+        if hasattr(self.handle, 'reset_input_buffer'):
+            self.handle.reset_input_buffer()
+
+    def close(self):
+        self.capture.close()
+        self.handle.close()
+
+def read_events(filename):
+    """
+    Return a list of (kind, timestamp, data) from a capture.
+    """
+    with open(filename, 'rb') as h:
+        data = h.read()
+    if not data.startswith(MAGIC):
+        raise maple.MapleError("%s isn't a maple capture" % (filename,))
+
+    events = []
+    pos = len(MAGIC)
+    while pos + EVENT.size <= len(data):
+        kind, timestamp, length = EVENT.unpack_from(data, pos)
+        pos += EVENT.size
+        events.append((kind, timestamp, data[pos : pos + length]))
+        pos += length
+    return events
+
+class ReplayHandle(object):
+    """
+    Serial-like object which plays back a capture. Each write must match what was written when it was
+    captured (unless strict is off); reads return what was read in response, in chunks of any size, and
+    b'' where the original read timed out.
+    """
+    def __init__(self, filename, strict=True):
+        self.events = read_events(filename)
+        self.strict = strict
+        self.pos = 0  # Next event
+        self.pending = bytearray()  # Part of a write event not yet matched
+        self.readable = bytearray()  # Part of a read event not yet read
+
+    def write(self, data):
+        data = bytes(data)
+        offset = 0
+        while offset < len(data):
+            if not self.pending:
+                # Anything the host didn't get round to reading before writing again is lost.
+                self.readable.clear()
+                while self.pos < len(self.events) and self.events[self.pos][0] != EVENT_WRITE:
+                    self.pos += 1
+                if self.pos == len(self.events):
+                    raise maple.MapleError("replay: write past the end of the capture")
+                self.pending.extend(self.events[self.pos][2])
+                self.pos += 1
+
+            num_bytes = min(len(self.pending), len(data) - offset)
+            if self.strict and self.pending[:num_bytes] != data[offset : offset + num_bytes]:
+                raise maple.MapleError("replay: write differs from the capture at event %d" % (self.pos - 1,))
+            del self.pending[:num_bytes]
+            offset += num_bytes
+        return len(data)
+
+    def read(self, size=1):
+        if not self.readable:
+            if self.pos == len(self.events) or self.events[self.pos][0] != EVENT_READ:
+                # The next thing the host did was write, so there's nothing more for it to read.
+                return b''
+            self.readable.extend(self.events[self.pos][2])
+            self.pos += 1
+            if not self.readable:
+                # This read timed out when captured.
+                return b''
+
+        data = bytes(self.readable[:size])
+        del self.readable[:size]
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self.readable)
+
+    def reset_input_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class Exchange(object):
+    """
+    A frame sent to the proxy and the proxy's reply, parsed out of a capture.
+    """
+    __slots__ = ('timestamp', 'packet', 'recv_skip', 'raw')
+
+    def __init__(self, timestamp, packet, recv_skip, raw):
+        self.timestamp = timestamp
+        self.packet = packet
+        self.recv_skip = recv_skip
+        self.raw = raw  # Raw samples, expanded if they were compressed; None if there was no reply
+
+def exchanges(events):
+    """
+    Yield an Exchange for each Maple frame in a capture, including those in batches. Handshakes are
+    followed to know whether replies are compressed.
+    """
+    # Everything read after a write, up to the next write, is the reply to it.
+    groups = []
+    for kind, timestamp, data in events:
+        if kind == EVENT_WRITE:
+            groups.append((timestamp, data, bytearray()))
+        elif groups:
+            groups[-1][2].extend(data)
+
+    options = 0
+    for timestamp, written, reads in groups:
+        write_pos = read_pos = 0
+
+        def take_reply():
+            nonlocal read_pos
+            if read_pos + 2 > len(reads):
+                return None
+            num_bytes, = struct.unpack_from('>H', reads, read_pos)
+            raw = bytes(reads[read_pos + 2 : read_pos + 2 + num_bytes])
+            read_pos += 2 + num_bytes
+            if options & maple.OPTION_RLE:
+                raw = maple.RLEExpander().expand(raw)
+            return raw
+
+        def take_frame():
+            nonlocal write_pos
+            length = written[write_pos]
+            recv_skip, = struct.unpack_from('<H', written, write_pos + 1)
+            packet = written[write_pos + 3 : write_pos + 3 + length]
+            write_pos += 3 + length
+            return packet, recv_skip
+
+        while write_pos + 3 <= len(written):
+            packet, recv_skip = take_frame()
+            if packet:
+                yield Exchange(timestamp, packet, recv_skip, take_reply())
+            elif recv_skip & maple.BATCH_MARKER:
+                batch = [take_frame() for _ in range(recv_skip & ~maple.BATCH_MARKER)]
+                for packet, frame_recv_skip in batch:
+                    yield Exchange(timestamp, packet, frame_recv_skip, take_reply())
+            elif recv_skip:
+                if reads[read_pos : read_pos + 1] == maple.OPTIONS_REPLY and read_pos + 1 < len(reads):
+                    options = reads[read_pos + 1] & recv_skip
+                read_pos += 2
+            else:
+                # Are-you-there, which also turns the options off again.
+                options = 0
+                read_pos += 1
+
+def main():
+    parser = argparse.ArgumentParser(description='Examine a maple session capture')
+    parser.add_argument('action', choices=('list', 'decode'),
+            help='list: show every frame and its reply; decode: time decoding every reply')
+    parser.add_argument('filename')
+    args = parser.parse_args()
+
+    found = list(exchanges(read_events(args.filename)))
+    if args.action == 'list':
+        for exchange in found:
+            if exchange.raw is None:
+                reply = 'no reply'
+            else:
+                decoded = maple.debittify(exchange.raw, exchange.recv_skip == 0)
+                reply = '%d raw bytes -> %d bytes, %s' % (len(exchange.raw), len(decoded.result),
+                        maple.describe_rx(decoded))
+            sys.stdout.write('%10.6f cmd %02x to %02x skip %5d: %s\n' % (exchange.timestamp,
+                maple.get_command(exchange.packet), exchange.packet[2], exchange.recv_skip, reply))
+    else:
+        replies = [(exchange.raw, exchange.recv_skip == 0) for exchange in found if exchange.raw]
+        num_samples = sum(len(raw) for raw, _ in replies) * maple.RAW_SAMPLES_PER_BYTE
+        started = time.perf_counter()
+        for raw, header in replies:
+            maple.debittify(raw, header)
+        elapsed = time.perf_counter() - started
+        print("%d replies, %d samples in %.3fs (%.0f samples/s)" % (len(replies), num_samples, elapsed,
+            num_samples / elapsed if elapsed else 0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Keep the proxy open and share it between tools over a Unix socket.
+
+Opening the serial port resets the Arduino, and every tool then has to wait for the are-you-there
+handshake and enumerate the bus again. The daemon does all of that once, and then runs transactions for
+any number of local clients, one at a time. Device information replies are cached, so enumerating the
+bus from a client doesn't touch it at all.
+
+    python3 maple_daemon.py -p /dev/ttyUSB0 &
+    python3 vmu_dump.py -p unix:/tmp/maple.sock dump.bin
+
+Any tool's port can be given as unix:<socket path> to use the daemon; see maple.connect.
+"""
+import os
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+
+import maple
+
+DEFAULT_SOCKET = '/tmp/maple.sock'
+
+# Every message is a 4-byte length followed by that many bytes. Requests start with an operation code.
+MESSAGE_LENGTH = struct.Struct('<I')
+OP_TRANSACT = 1  # command, recipient, flags, data
+OP_BATCH = 2     # flags, count, then count of (command, recipient, data length, data)
+OP_FORGET = 3    # Drop cached device information
+
+FLAG_ALLOW_REPEATS = 0x01
+FLAG_REQUIRE_VALID = 0x02  # A bad reply comes back as an error
+
+# Replies start with a status byte. An error is followed by its message.
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+REQUEST = struct.Struct('<BBB')
+BATCH_HEADER = struct.Struct('<BH')
+BATCH_ENTRY = struct.Struct('<BBH')
+REPLY_LENGTH = struct.Struct('<H')
+
+def send_message(sock, payload):
+    sock.sendall(MESSAGE_LENGTH.pack(len(payload)) + payload)
+
+def recv_exactly(sock, num_bytes):
+    data = bytearray()
+    while len(data) < num_bytes:
+        chunk = sock.recv(num_bytes - len(data))
+        if not chunk:
+            raise EOFError()
+        data.extend(chunk)
+    return bytes(data)
+
+def recv_message(sock):
+    num_bytes, = MESSAGE_LENGTH.unpack(recv_exactly(sock, MESSAGE_LENGTH.size))
+    return recv_exactly(sock, num_bytes)
+
+def request_flags(allow_repeats, require_valid):
+    return (FLAG_ALLOW_REPEATS if allow_repeats else 0) | (FLAG_REQUIRE_VALID if require_valid else 0)
+
+class MapleDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, bus, path=DEFAULT_SOCKET):
+        self.bus = bus
+        self.bus_lock = threading.Lock()
+        self.device_info = {}  # address -> CMD_INFO reply
+        self.num_transactions = 0
+        self.num_cached = 0
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, DaemonHandler)
+
+    def enumerate(self):
+        # Nothing will work before you do a deviceInfo on the controller.
+        for address in (maple.ADDRESS_CONTROLLER, maple.ADDRESS_PERIPH1):
+            self.transact(maple.CMD_INFO, address, b'', allow_repeats=True)
+
+    def transact(self, command, recipient, data, allow_repeats=False, require_valid=False):
+        with self.bus_lock:
+            # Looked up under the lock, as another client's transaction may be dropping it from the cache.
+            cached = self.device_info.get(recipient) if command == maple.CMD_INFO else None
+            if cached is not None:
+                self.num_cached += 1
+                return cached
+
+            reply = self.bus.transact(command, recipient, data, allow_repeats=allow_repeats,
+                    require_valid=require_valid)
+            self.num_transactions += 1
+            self._update_cache(command, recipient, reply)
+        return reply
+
+    def transact_batch(self, requests, allow_repeats=False, require_valid=False):
+        with self.bus_lock:
+            replies = self.bus.transact_batch(requests, allow_repeats=allow_repeats,
+                    require_valid=require_valid)
+            self.num_transactions += len(requests)
+            for (command, recipient, _), reply in zip(requests, replies):
+                self._update_cache(command, recipient, reply)
+        return replies
+
+    def _update_cache(self, command, recipient, reply):
+        if command == maple.CMD_INFO and maple.get_command(reply) == maple.CMD_INFO_RESP:
+            self.device_info[recipient] = reply
+        elif command == maple.CMD_RESET or not reply:
+            # The device has gone away, or will come back as something new.
+            self.device_info.pop(recipient, None)
+
+    def forget(self):
+        self.device_info.clear()
+
+    def server_close(self):
+        path = self.server_address
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(path):
+            os.unlink(path)
+
+class DaemonHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = recv_message(self.request)
+            except (EOFError, ConnectionError):
+                return
+            try:
+                reply = bytes([STATUS_OK]) + self.dispatch(request)
+            except Exception as e:
+                reply = bytes([STATUS_ERROR]) + str(e).encode('utf-8', 'replace')
+            send_message(self.request, reply)
+
+    def dispatch(self, request):
+        op = request[0]
+        if op == OP_TRANSACT:
+            command, recipient, flags = REQUEST.unpack_from(request, 1)
+            return self.server.transact(command, recipient, request[1 + REQUEST.size:],
+                    allow_repeats=bool(flags & FLAG_ALLOW_REPEATS),
+                    require_valid=bool(flags & FLAG_REQUIRE_VALID))
+        elif op == OP_BATCH:
+            flags, count = BATCH_HEADER.unpack_from(request, 1)
+            pos = 1 + BATCH_HEADER.size
+            requests = []
+            for _ in range(count):
+                command, recipient, data_len = BATCH_ENTRY.unpack_from(request, pos)
+                pos += BATCH_ENTRY.size
+                requests.append((command, recipient, request[pos : pos + data_len]))
+                pos += data_len
+            replies = self.server.transact_batch(requests, allow_repeats=bool(flags & FLAG_ALLOW_REPEATS),
+                    require_valid=bool(flags & FLAG_REQUIRE_VALID))
+            return b''.join(REPLY_LENGTH.pack(len(reply)) + reply for reply in replies)
+        elif op == OP_FORGET:
+            self.server.forget()
+            return b''
+        raise maple.MapleError("unknown daemon request %d" % (op,))
+
+class DaemonClient(maple.MapleProxy):
+    """
+    A MapleProxy which sends its transactions to a MapleDaemon. With metrics attached, each transaction
+    records its total time and one pass per request to the daemon; the serial side happens in the daemon.
+    """
+    runs_passes = False
+
+    def __init__(self, path=DEFAULT_SOCKET):
+        # The daemon batches and retries for us, so options are left off.
+        self._init_state()
+        self.handle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.handle.connect(path)
+
+    def _request(self, request):
+        if self._record is not None:
+            self._record.passes += 1
+        send_message(self.handle, request)
+        reply = recv_message(self.handle)
+        if reply[0] != STATUS_OK:
+            raise maple.MapleError("daemon: %s" % (reply[1:].decode('utf-8', 'replace'),))
+        return reply[1:]
+
+    def transact(self, command, recipient, data, debug_write_filename=None, allow_repeats=False,
+            require_valid=False):
+        """
+        As MapleProxy.transact. Raw replies stay in the daemon, so debug_write_filename is ignored.
+        """
+        flags = request_flags(allow_repeats, require_valid)
+        request = bytes([OP_TRANSACT]) + REQUEST.pack(command, recipient, flags) + bytes(data)
+        return self._instrumented(command, self._request, request)
+
+    def transact_batch(self, requests, allow_repeats=False, require_valid=False):
+        return self._instrumented(maple.BATCH_LABEL, self._transact_batch, requests, allow_repeats,
+                require_valid)
+
+    def _transact_batch(self, requests, allow_repeats, require_valid):
+        flags = request_flags(allow_repeats, require_valid)
+        message = [bytes([OP_BATCH]), BATCH_HEADER.pack(flags, len(requests))]
+        for command, recipient, data in requests:
+            message.append(BATCH_ENTRY.pack(command, recipient, len(data)) + bytes(data))
+        reply = self._request(b''.join(message))
+
+        replies = []
+        pos = 0
+        for _ in requests:
+            reply_len, = REPLY_LENGTH.unpack_from(reply, pos)
+            pos += REPLY_LENGTH.size
+            replies.append(reply[pos : pos + reply_len])
+            pos += reply_len
+        return replies
+
+    def forget_daemon_cache(self):
+        """
+        Make the daemon enumerate devices again rather than using its cached information.
+        """
+        self._request(bytes([OP_FORGET]))
+
+def main():
+    parser = argparse.ArgumentParser(description='Share the maple proxy between tools')
+    parser.add_argument('-p', '--port', default=maple.PORT)
+    parser.add_argument('-s', '--socket', default=DEFAULT_SOCKET)
+    args = parser.parse_args()
+
+    bus = maple.MapleProxy(args.port)
+    server = MapleDaemon(bus, args.socket)
+    server.enumerate()
+    print("Serving on unix:%s" % (args.socket,))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    print("%d transactions, %d answered from cache" % (server.num_transactions, server.num_cached))
+
+if __name__ == '__main__':
+    main()
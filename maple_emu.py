@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+"""
+Software emulation of the Arduino maple proxy, with a controller and VMU plugged in.
+
+EmulatedProxy speaks the proxy's serial protocol (are-you-there, length/recv_skip/packet frames and
+length-prefixed raw sample replies) and can be handed straight to MapleProxy as its handle. Replies are
+encoded back into the 4-samples-per-byte pin format which debittify expects, with the proxy's fixed-size
+receive buffer and recv_skip honoured, so multi-pass reads behave as they do on hardware.
+
+Run this module to serve an emulated proxy on a pty, which the command-line tools can then be pointed at
+using --port.
+"""
+import os
+import sys
+import time
+import tty
+import random
+import struct
+import argparse
+import threading
+
+import maple
+
+BLOCK_SIZE = 512
+NUM_BLOCKS = 256
+LCD_SIZE = 192
+
+# The proxy reads 255 loops of 6 raw bytes into its buffer, always filling it.
+PROXY_RX_BUFFER_SIZE = 255 * 6
+PROXY_RX_SAMPLES = PROXY_RX_BUFFER_SIZE * maple.RAW_SAMPLES_PER_BYTE
+
+# Both-lines-high samples at the start of every reply. Must be even so that recv_skip, which skips
+# samples in pairs, lands on byte boundaries.
+LEAD_IN_SAMPLES = 4
+
+# Samples are stored one per element as (pin5 << 1) | pin1.
+SAMPLE_IDLE = 3
+
+# End-of-frame sequence: produces a few stray bits but never a whole byte.
+END_SEQUENCE = [0b01, 0b11, 0b01, 0b00, 0b01, 0b00, 0b01]
+
+def encode_frame(frame):
+    """
+    Turn a frame (header, payload and checksum) into a list of samples as the proxy would see them,
+    two samples per bit, starting just after the start-of-frame sequence.
+    """
+    samples = [SAMPLE_IDLE] * LEAD_IN_SAMPLES
+    for byte in frame:
+        for bit_num in range(7, -1, -2):
+            # Phase 1: data on pin 5, clocked by pin 1 falling.
+            bit = (byte >> bit_num) & 1
+            samples.append((bit << 1) | 1)
+            samples.append(bit << 1)
+            # Phase 2: data on pin 1, clocked by pin 5 falling.
+            bit = (byte >> (bit_num - 1)) & 1
+            samples.append(2 | bit)
+            samples.append(bit)
+    samples.extend(END_SEQUENCE)
+    return samples
+
+def pack_samples(samples):
+    """
+    Pack samples four to a byte in the proxy's "33 11 22 44" order.
+    """
+    packed = bytearray()
+    for idx in range(0, len(samples) - 3, 4):
+        first, second, third, fourth = samples[idx : idx + 4]
+        packed.append((third << 6) | (first << 4) | (second << 2) | fourth)
+    return bytes(packed)
+
+def raw_reply(frame, recv_skip, skip_loop_length=maple.SKIP_LOOP_LENGTH):
+    """
+    The raw buffer the proxy would capture for the given reply frame and recv_skip, with a skip loop
+    skip_loop_length samples long.
+    """
+    samples = encode_frame(frame)
+    start = int(recv_skip * skip_loop_length)
+    window = samples[start : start + PROXY_RX_SAMPLES]
+    window.extend([SAMPLE_IDLE] * (PROXY_RX_SAMPLES - len(window)))
+    return pack_samples(window)
+
+def build_frame(command, sender, payload):
+    """
+    Construct a reply frame to the Dreamcast.
+    """
+    assert len(payload) % 4 == 0
+    frame = bytes([len(payload) // 4, sender, maple.ADDRESS_DC, command]) + payload
+    return frame + bytes([maple.compute_checksum(frame)])
+
+def pack_device_info(func, func_data, name, license, max_power, standby_power):
+    # Area code and connector direction precede the name.
+    name = (b'\xff\x00' + name).ljust(32, b' ')
+    license = license.ljust(60, b' ')
+    return struct.pack("<IIII", func, *func_data) + maple.swapwords(name) + maple.swapwords(license) + \
+            struct.pack(">HH", max_power, standby_power)
+
+class EmulatedDevice(object):
+    """
+    Base class for emulated Maple peripherals. Subclasses provide info_payload and handle_* methods.
+    """
+    address = None
+
+    def handle(self, command, payload):
+        """
+        Return the reply frame for a command.
+        """
+        if command == maple.CMD_INFO:
+            return build_frame(maple.CMD_INFO_RESP, self.address, self.info_payload())
+
+        handler = getattr(self, 'handle_%02x' % (command,), None)
+        if handler is None:
+            return build_frame(maple.CMD_UNKNOWN_RESP, self.address, b'')
+
+        return handler(payload)
+
+    def ack(self):
+        return build_frame(maple.CMD_ACK_RESP, self.address, b'')
+
+    def handle_03(self, payload):
+        # CMD_RESET
+        return self.ack()
+
+class EmulatedController(EmulatedDevice):
+    """
+    A standard controller with a VMU in the first slot. Set buttons (a mask of pressed buttons, using
+    maple.BUTTONS bit order), triggers and sticks to change what getCond reports.
+    """
+    address = maple.ADDRESS_CONTROLLER | maple.ADDRESS_PERIPH1
+
+    def __init__(self):
+        self.buttons = 0
+        self.ltrig = self.rtrig = 0
+        self.joy_x = self.joy_y = self.joy_x2 = self.joy_y2 = 0x80
+
+    def info_payload(self):
+        return pack_device_info(maple.FN_CONTROLLER, (0xfe060f00, 0, 0), b'Dreamcast Controller',
+                b'Produced By or Under License From SEGA ENTERPRISES,LTD.', 0x01ae, 0x01f4)
+
+    def condition(self):
+        return maple.swapwords(struct.pack("<HBBBBBB", ~self.buttons & 0xffff, self.rtrig, self.ltrig,
+            self.joy_x, self.joy_y, self.joy_x2, self.joy_y2))
+
+    def handle_09(self, payload):
+        # CMD_GET_COND
+        func, = struct.unpack("<I", payload[:4])
+        if func != maple.FN_CONTROLLER:
+            return build_frame(maple.CMD_UNSUP_FN_RESP, self.address, b'')
+        return build_frame(maple.CMD_XFER_RESP, self.address, payload[:4] + self.condition())
+
+class EmulatedVMU(EmulatedDevice):
+    """
+    A VMU with 256 blocks of flash, an LCD and a clock. flash is a bytearray of the card contents in
+    block order, as vmu_dump would write it.
+    """
+    address = maple.ADDRESS_PERIPH1
+
+    def __init__(self, image=None):
+        self.flash = bytearray(NUM_BLOCKS * BLOCK_SIZE)
+        if image is not None:
+            self.flash[:len(image)] = image
+        self.lcd = bytearray(LCD_SIZE)
+        self.num_reads = 0
+        self.num_writes = 0
+        self.num_lcd_writes = 0
+
+    def info_payload(self):
+        return pack_device_info(maple.FN_MEMORY_CARD | maple.FN_LCD | maple.FN_CLOCK,
+                (0x7e7e3f40, 0x00051000, 0x000f4100), b'Visual Memory',
+                b'Produced By or Under License From SEGA ENTERPRISES,LTD.', 0x007c, 0x0082)
+
+    def handle_09(self, payload):
+        # CMD_GET_COND
+        func, = struct.unpack("<I", payload[:4])
+        if func != maple.FN_CLOCK:
+            return build_frame(maple.CMD_UNSUP_FN_RESP, self.address, b'')
+        now = time.localtime()
+        clock = struct.pack("<HBBBBBB", now.tm_year, now.tm_mon, now.tm_mday, now.tm_hour, now.tm_min,
+                now.tm_sec, now.tm_wday)
+        return build_frame(maple.CMD_XFER_RESP, self.address, payload[:4] + maple.swapwords(clock))
+
+    def handle_0a(self, payload):
+        # CMD_GET_MEMINFO: same layout as vmu_flash.construct_fs_image.
+        meminfo = struct.pack("<IHHHHHHHHHHHH", maple.FN_MEMORY_CARD, NUM_BLOCKS - 1, 0, 255, 254, 1,
+                253, 13, 0, 200, 0, 0, 0)
+        return build_frame(maple.CMD_XFER_RESP, self.address, maple.swapwords(meminfo))
+
+    def handle_0b(self, payload):
+        # CMD_READ
+        func, addr = struct.unpack("<II", payload[:8])
+        block = addr & 0xffff
+        if func != maple.FN_MEMORY_CARD or block >= NUM_BLOCKS:
+            return build_frame(maple.CMD_FILE_ERR_RESP, self.address, b'')
+        self.num_reads += 1
+        data = bytes(self.flash[block * BLOCK_SIZE : (block + 1) * BLOCK_SIZE])
+        return build_frame(maple.CMD_XFER_RESP, self.address, payload[:8] + maple.swapwords(data))
+
+    def handle_0c(self, payload):
+        # CMD_WRITE
+        func, addr = struct.unpack("<II", payload[:8])
+        data = payload[8:]
+        if func == maple.FN_LCD:
+            self.lcd[:] = data[:LCD_SIZE].ljust(LCD_SIZE, b'\x00')
+            self.num_lcd_writes += 1
+            return self.ack()
+
+        block = addr & 0xffff
+        phase = (addr >> 16) & 0xff
+        if func != maple.FN_MEMORY_CARD or block >= NUM_BLOCKS or phase >= 4 or len(data) != 128:
+            return build_frame(maple.CMD_FILE_ERR_RESP, self.address, b'')
+        self.num_writes += 1
+        offset = block * BLOCK_SIZE + phase * 128
+        self.flash[offset : offset + 128] = maple.swapwords(data)
+        return self.ack()
+
+    def handle_0d(self, payload):
+        # CMD_WRITE_COMPLETE
+        return self.ack()
+
+def default_devices(image=None):
+    """
+    A controller with a VMU, containing the given image, in its first slot.
+    """
+    return {maple.ADDRESS_CONTROLLER: EmulatedController(), maple.ADDRESS_PERIPH1: EmulatedVMU(image)}
+
+class EmulatedProxy(object):
+    """
+    Serial-like object which behaves like the Arduino proxy with the given devices (a dict mapping
+    address to EmulatedDevice) attached. By default a controller with a VMU in its first slot.
+
+    noise: probability of flipping a random sample bit in each raw reply byte.
+    truncate: probability of a raw reply being cut short on the wire.
+    latency: seconds added to each transaction.
+    baud: if given, also sleep for as long as the serial transfer would take at this rate.
+    supported_options: handshake options understood, as maple.OPTION_*. 0 behaves like old firmware.
+    skip_loop_length: samples skipped per unit of recv_skip, which needn't be a whole number.
+    """
+    def __init__(self, devices=None, noise=0.0, truncate=0.0, latency=0.0, baud=None, seed=None,
+            supported_options=maple.SUPPORTED_OPTIONS, skip_loop_length=maple.SKIP_LOOP_LENGTH):
+        if devices is None:
+            devices = default_devices()
+        self.devices = devices
+        self.noise = noise
+        self.truncate = truncate
+        self.latency = latency
+        self.baud = baud
+        self.supported_options = supported_options
+        self.skip_loop_length = skip_loop_length
+        self.options = 0
+        self.random = random.Random(seed)
+        self.rx = bytearray()  # From the host, not yet processed
+        self.tx = bytearray()  # To the host, not yet read
+        self.num_frames = 0  # Maple frames run
+        self.num_round_trips = 0  # Serial messages answered, each of one frame or a batch
+        self.num_handshakes = 0
+        self.bytes_to_host = 0
+        self.bytes_from_host = 0
+
+    @property
+    def vmu(self):
+        return self.devices.get(maple.ADDRESS_PERIPH1)
+
+    @property
+    def controller(self):
+        return self.devices.get(maple.ADDRESS_CONTROLLER)
+
+    def write(self, data):
+        self.rx.extend(data)
+        self.bytes_from_host += len(data)
+        while self._process_frame():
+            pass
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self.tx[:size])
+        del self.tx[:size]
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self.tx)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self.tx.clear()
+
+    def close(self):
+        pass
+
+    def _frame_at(self, pos):
+        """
+        Return (packet, recv_skip, end) for the frame starting at pos in rx, or None if it hasn't all
+        arrived yet. Frame: 1 byte length, 2 bytes recv_skip, then the packet.
+        """
+        if len(self.rx) < pos + 3 or len(self.rx) < pos + 3 + self.rx[pos]:
+            return None
+        length = self.rx[pos]
+        recv_skip, = struct.unpack_from("<H", self.rx, pos + 1)
+        return bytes(self.rx[pos + 3 : pos + 3 + length]), recv_skip, pos + 3 + length
+
+    def _process_frame(self):
+        frame = self._frame_at(0)
+        if frame is None:
+            return False
+
+        packet, recv_skip, end = frame
+        if not packet and recv_skip & maple.BATCH_MARKER and self.options & maple.OPTION_BATCH:
+            # The proxy reads the whole batch before running any of it.
+            batch = []
+            for _ in range(recv_skip & ~maple.BATCH_MARKER):
+                frame = self._frame_at(end)
+                if frame is None:
+                    return False
+                packet, frame_recv_skip, end = frame
+                batch.append((packet, frame_recv_skip))
+            assert end - 3 <= maple.BATCH_BUFFER_SIZE
+            del self.rx[:end]
+
+            self.num_round_trips += 1
+            # A frame nothing responded to still gets an (empty) reply, to keep the rest in step.
+            replies = [self._reply(packet, frame_recv_skip) or struct.pack(">H", 0)
+                    for packet, frame_recv_skip in batch]
+            self._send(b''.join(replies), request_length=end)
+            return True
+
+        del self.rx[:end]
+        if not packet:
+            # Are-you-there, possibly asking for options.
+            self.num_handshakes += 1
+            if recv_skip and self.supported_options:
+                self.options = recv_skip & self.supported_options
+                self._send(maple.OPTIONS_REPLY + bytes([self.options]))
+            else:
+                self.options = 0
+                self._send(maple.HANDSHAKE_REPLY)
+        else:
+            self.num_round_trips += 1
+            reply = self._reply(packet, recv_skip)
+            if reply is not None:
+                self._send(reply, request_length=end)
+        return True
+
+    def _reply(self, packet, recv_skip):
+        """
+        Run a frame and return the proxy's serial reply: the length and raw samples, or None if nothing
+        responded.
+        """
+        self.num_frames += 1
+        reply = self.transact(packet, recv_skip)
+        if reply is None:
+            return None
+        if self.options & maple.OPTION_RLE:
+            reply = maple.rle_encode(reply)
+        return struct.pack(">H", len(reply)) + self._corrupt(reply)
+
+    def _send(self, data, request_length=0):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.baud:
+            # 10 bits per byte on the wire.
+            time.sleep((request_length + len(data)) * 10 / self.baud)
+        self.tx.extend(data)
+        self.bytes_to_host += len(data)
+
+    def _corrupt(self, raw):
+        if self.noise:
+            raw = bytearray(raw)
+            for idx in range(len(raw)):
+                if self.random.random() < self.noise:
+                    raw[idx] ^= 1 << self.random.randrange(8)
+            raw = bytes(raw)
+        if self.truncate and self.random.random() < self.truncate:
+            raw = raw[:self.random.randrange(len(raw))]
+        return raw
+
+    def transact(self, packet, recv_skip):
+        """
+        Send a packet on the emulated bus and return the raw reply buffer, or None if nothing responded.
+        """
+        if len(packet) < 5:
+            return None
+
+        command = packet[3]
+        recipient = packet[2]
+        payload = packet[4:-1]
+
+        device = self.devices.get(recipient)
+        if device is None:
+            # The real proxy waits forever for a reply which never comes.
+            return None
+
+        if maple.compute_checksum(packet) != 0 or len(payload) != packet[0] * 4:
+            frame = build_frame(maple.CMD_RESEND_RESP, device.address, b'')
+        else:
+            frame = device.handle(command, payload)
+
+        return raw_reply(frame, recv_skip, self.skip_loop_length)
+
+def serve_pty(proxy):
+    """
+    Serve the emulated proxy on a new pty. Returns the pty's path; serving happens on a daemon thread.
+    """
+    master, slave = os.openpty()
+    tty.setraw(slave)
+
+    def serve():
+        while True:
+            try:
+                data = os.read(master, 4096)
+            except OSError:
+                return
+            proxy.write(data)
+            reply = proxy.read(len(proxy.tx))
+            if reply:
+                os.write(master, reply)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    return os.ttyname(slave)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--image', default=None, help='initial VMU contents, e.g. from vmu_dump')
+    parser.add_argument('-s', '--save', default=None, help='save VMU contents here on exit')
+    parser.add_argument('--noise', type=float, default=0.0)
+    parser.add_argument('--truncate', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--baud', type=int, default=None)
+    parser.add_argument('--old-firmware', action='store_true', help="don't support handshake options")
+    parser.add_argument('--skip-loop-length', type=float, default=maple.SKIP_LOOP_LENGTH,
+            help='samples skipped per unit of recv_skip')
+    args = parser.parse_args()
+
+    image = None
+    if args.image:
+        with open(args.image, 'rb') as h:
+            image = h.read()
+
+    proxy = EmulatedProxy(default_devices(image), noise=args.noise, truncate=args.truncate,
+            latency=args.latency, baud=args.baud,
+            supported_options=0 if args.old_firmware else maple.SUPPORTED_OPTIONS,
+            skip_loop_length=args.skip_loop_length)
+    print("Emulated proxy on %s" % (serve_pty(proxy),))
+    sys.stdout.flush()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    if args.save:
+        with open(args.save, 'wb') as h:
+            h.write(proxy.vmu.flash)
+
+if __name__ == '__main__':
+    main()
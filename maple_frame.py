@@ -0,0 +1,88 @@
+"""
+Frame encoding without per-call allocation.
+
+A Frame owns a buffer big enough for the largest serial message to the proxy -- length, recv_skip,
+header, payload and checksum -- and packs into it in place. Sending the same frame again with another
+recv_skip only rewrites those two bytes. Word swapping and checksums are done in bulk rather than byte
+by byte.
+"""
+import array
+import struct
+
+# The frame's length goes in a byte, so the largest payload is 255 bytes less the header and checksum.
+MAX_PAYLOAD = 255 - 4 - 1
+
+MESSAGE_PREFIX = struct.Struct('<BH')  # length, recv_skip
+RECV_SKIP = struct.Struct('<H')
+HEADER = struct.Struct('<BBBB')  # words, sender, recipient, command
+HEADER_OFFSET = MESSAGE_PREFIX.size
+PAYLOAD_OFFSET = HEADER_OFFSET + HEADER.size
+
+WORD_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+
+def swapwords(data):
+    """
+    Reverse the bytes of each 32-bit word in data. A trailing partial word is reversed too.
+    """
+    num_whole = len(data) & ~3
+    words = array.array(WORD_TYPECODE)
+    words.frombytes(data[:num_whole])
+    words.byteswap()
+    if num_whole == len(data):
+        return words.tobytes()
+    return words.tobytes() + bytes(data[num_whole:])[::-1]
+
+def compute_checksum(data):
+    """
+    XOR of every byte in data. Rather than going byte by byte, data is read as one integer and folded
+    in half until a single byte is left.
+    """
+    value = int.from_bytes(data, 'little')
+    num_bytes = len(data)
+    while num_bytes > 1:
+        half = (num_bytes + 1) // 2
+        value = (value & ((1 << (half * 8)) - 1)) ^ (value >> (half * 8))
+        num_bytes = half
+    return value
+
+class Frame(object):
+    """
+    A frame for the proxy to send, held as the whole serial message in a reusable buffer.
+    """
+    __slots__ = ('buffer', 'view', 'length')
+
+    def __init__(self):
+        self.buffer = bytearray(PAYLOAD_OFFSET + MAX_PAYLOAD + 1)
+        self.view = memoryview(self.buffer)
+        self.length = 0  # Of the packet: header, payload and checksum
+
+    def pack(self, command, recipient, sender, data):
+        """
+        Fill in the header, data and checksum. Returns self.
+        """
+        num_bytes = len(data)
+        assert num_bytes <= MAX_PAYLOAD, data
+        self.length = HEADER.size + num_bytes + 1
+        MESSAGE_PREFIX.pack_into(self.buffer, 0, self.length, 0)
+        HEADER.pack_into(self.buffer, HEADER_OFFSET, num_bytes // 4, sender, recipient, command)
+        end = PAYLOAD_OFFSET + num_bytes
+        self.buffer[PAYLOAD_OFFSET : end] = data
+        self.buffer[end] = compute_checksum(self.view[HEADER_OFFSET : end])
+        return self
+
+    def packet(self):
+        """
+        A view of the frame as it goes on the bus.
+        """
+        return self.view[HEADER_OFFSET : HEADER_OFFSET + self.length]
+
+    def message(self, recv_skip):
+        """
+        A view of the serial message asking the proxy to send the frame, skipping recv_skip in the reply.
+        The view is only good until the frame is next packed or sent.
+        """
+        RECV_SKIP.pack_into(self.buffer, 1, recv_skip)
+        return self.view[: HEADER_OFFSET + self.length]
+
+    def message_size(self):
+        return HEADER_OFFSET + self.length
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Convert images straight to VMU LCD data, without going through pgmtotxt and a text file.
+
+Reads PGM and PBM images (binary or ASCII, several concatenated in one stream, as ImageMagick writes for
+an animation) or raw 8-bit greyscale frames, thresholds them all at once and packs the pixels using a
+layout table precomputed from maple.lcd_bit_position. Frames can be saved to a frame file: 192-byte LCD
+images back to back, which FrameFile memory-maps for vmu_image to play.
+
+    convert anim.gif -resize 48x32! pgm:- | python3 maple_lcd.py -o anim.lcd -
+
+Requires numpy.
+"""
+import os
+import sys
+import mmap
+import argparse
+
+import numpy as np
+
+import maple
+
+LCD_BYTES = maple.LCD_WIDTH * maple.LCD_HEIGHT // 8
+FRAME_FILE_SUFFIX = '.lcd'
+PNM_MAGICS = (b'P1', b'P2', b'P4', b'P5')
+
+class ImageError(Exception):
+    pass
+
+def build_layout():
+    """
+    For each bit of the LCD data in order (byte by byte, least significant bit first), the index of its
+    pixel in a row-major, top-to-bottom image.
+    """
+    layout = np.zeros(maple.LCD_WIDTH * maple.LCD_HEIGHT, dtype=np.intp)
+    for row in range(maple.LCD_HEIGHT):
+        for x in range(maple.LCD_WIDTH):
+            byte, bit = maple.lcd_bit_position(x, maple.LCD_HEIGHT - 1 - row)
+            layout[byte * 8 + bit] = row * maple.LCD_WIDTH + x
+    return layout
+
+LAYOUT = build_layout()
+
+def pack_frames(pixels):
+    """
+    Pack an array of set pixels, shaped (frames, 32, 48) or (32, 48), into LCD data. Returns an array
+    of shape (frames, 192) or (192,).
+    """
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    flat = pixels.reshape(pixels.shape[:-2] + (-1,))
+    bits = flat[..., LAYOUT].reshape(flat.shape[:-1] + (LCD_BYTES, 8))
+    return np.packbits(bits, axis=-1, bitorder='little').reshape(flat.shape[:-1] + (LCD_BYTES,))
+
+def _pnm_tokens(data, pos, count):
+    """
+    Read count whitespace-separated header fields starting at pos, skipping comments. Returns the
+    fields and the position just after the last one.
+    """
+    tokens = []
+    while len(tokens) < count:
+        while pos < len(data) and data[pos:pos + 1].isspace():
+            pos += 1
+        if data[pos:pos + 1] == b'#':
+            pos = data.index(b'\n', pos)
+            continue
+        end = pos
+        while end < len(data) and not data[end:end + 1].isspace() and data[end:end + 1] != b'#':
+            end += 1
+        if end == pos:
+            raise ImageError("truncated PNM header")
+        tokens.append(data[pos:end])
+        pos = end
+    return tokens, pos
+
+def read_pnm(data, pos=0):
+    """
+    Read one PGM or PBM image from data at pos. Returns a (height, width) array of set (dark) pixels
+    and the position of the next image.
+    """
+    magic = bytes(data[pos:pos + 2])
+    if magic not in PNM_MAGICS:
+        raise ImageError("not a PGM or PBM image: %r" % (magic,))
+    bitmap = magic in (b'P1', b'P4')
+    fields, pos = _pnm_tokens(data, pos + 2, 2 if bitmap else 3)
+    width, height = int(fields[0]), int(fields[1])
+    levels = 1 if bitmap else int(fields[2])
+    if levels > 255:
+        raise ImageError("16-bit images aren't supported")
+
+    if magic in (b'P1', b'P2'):
+        values, pos = _pnm_tokens(data, pos, width * height)
+        values = np.array([int(value) for value in values]).reshape(height, width)
+    else:
+        pos += 1  # Single whitespace character after the header
+        if magic == b'P4':
+            row_bytes = (width + 7) // 8
+            raw = np.frombuffer(data, dtype=np.uint8, count=row_bytes * height, offset=pos)
+            values = np.unpackbits(raw.reshape(height, row_bytes), axis=1)[:, :width]
+            pos += row_bytes * height
+        else:
+            values = np.frombuffer(data, dtype=np.uint8, count=width * height, offset=pos)
+            values = values.reshape(height, width)
+            pos += width * height
+
+    # In a PBM 1 is black; in a PGM dark levels are set, as in pgmtotxt.
+    pixels = values == 1 if bitmap else values < levels // 2
+    return pixels, pos
+
+def read_pnm_stream(data):
+    """
+    Read every image from a stream of concatenated PGM/PBM images. Returns (frames, 32, 48) pixels.
+    """
+    frames = []
+    pos = 0
+    while pos < len(data) and data[pos:].strip():
+        while data[pos:pos + 1].isspace():
+            pos += 1
+        pixels, pos = read_pnm(data, pos)
+        check_size(pixels.shape[1], pixels.shape[0])
+        frames.append(pixels)
+    return np.stack(frames)
+
+def read_raw(data, threshold=128):
+    """
+    Read back-to-back raw 8-bit greyscale 48x32 frames.
+    """
+    frame_size = maple.LCD_WIDTH * maple.LCD_HEIGHT
+    if len(data) % frame_size:
+        raise ImageError("raw data isn't a whole number of %d-byte frames" % (frame_size,))
+    values = np.frombuffer(data, dtype=np.uint8).reshape(-1, maple.LCD_HEIGHT, maple.LCD_WIDTH)
+    return values < threshold
+
+def check_size(width, height):
+    if (width, height) != (maple.LCD_WIDTH, maple.LCD_HEIGHT):
+        raise ImageError("image is %dx%d, not %dx%d" % (width, height, maple.LCD_WIDTH, maple.LCD_HEIGHT))
+
+class FrameFile(object):
+    """
+    A memory-mapped frame file. Frames are zero-copy memoryviews of 192 bytes.
+    """
+    def __init__(self, filename):
+        self.handle = open(filename, 'rb')
+        size = os.fstat(self.handle.fileno()).st_size
+        if size == 0 or size % LCD_BYTES:
+            self.handle.close()
+            raise ImageError("%s isn't a whole number of %d-byte frames" % (filename, LCD_BYTES))
+        self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.data) // LCD_BYTES
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return memoryview(self.data)[idx * LCD_BYTES : (idx + 1) * LCD_BYTES]
+
+    def close(self):
+        self.data.close()
+        self.handle.close()
+
+def write_frame_file(filename, frames):
+    with open(filename, 'wb') as handle:
+        handle.write(np.ascontiguousarray(frames, dtype=np.uint8).tobytes())
+
+def load_frames(filename, raw=False):
+    """
+    Return the LCD data of each frame in filename: a frame file, a text image, a PGM/PBM stream or, if
+    raw is set, raw greyscale. '-' reads a PGM/PBM or raw stream from stdin.
+    """
+    if filename.endswith(FRAME_FILE_SUFFIX):
+        return FrameFile(filename)
+    if filename.endswith('.txt'):
+        return [maple.load_image(filename)]
+
+    if filename == '-':
+        data = sys.stdin.buffer.read()
+    else:
+        with open(filename, 'rb') as handle:
+            data = handle.read()
+    pixels = read_raw(data) if raw else read_pnm_stream(data)
+    return [frame.tobytes() for frame in pack_frames(pixels)]
+
+def input_files(paths):
+    """
+    Expand directories into their files, in name order.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if not name.startswith('.'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert images to a VMU LCD frame file')
+    parser.add_argument('-o', '--output', required=True, help='frame file to write')
+    parser.add_argument('-r', '--raw', action='store_true', help='inputs are raw 8-bit 48x32 greyscale')
+    parser.add_argument('inputs', nargs='+', help="images, directories of images, or '-' for stdin")
+    args = parser.parse_args()
+
+    frames = []
+    for filename in input_files(args.inputs):
+        frames.extend(bytes(frame) for frame in load_frames(filename, args.raw))
+
+    write_frame_file(args.output, np.frombuffer(b''.join(frames), dtype=np.uint8))
+    print("Wrote %d frames to %s" % (len(frames), args.output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Opt-in instrumentation of MapleProxy transactions.
+
+Attach a Metrics to a proxy and every transaction is recorded, per command, into histograms of:
+
+    write_seconds       time spent writing frames to the serial port
+    first_byte_seconds  time from the end of a write to the start of its reply
+    raw_bytes           reply bytes received over serial
+    samples             samples decoded
+    decode_seconds      time spent decoding
+    passes              serial round trips (recv_skip passes, or batches)
+    retries             attempts after the first
+    truncated           attempts whose reply ended before its header said it would
+    total_seconds       the whole transaction
+
+    bus.metrics = maple_metrics.Metrics()
+    ...
+    print(bus.metrics.to_prometheus())
+
+With no Metrics attached, which is the default, the proxy only pays for a few checks against None.
+"""
+import json
+import time
+import bisect
+import threading
+
+import maple
+
+TIME_BUCKETS = (0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3)
+SIZE_BUCKETS = (16, 64, 256, 1024, 2048, 4096, 8192, 16384, 65536)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10)
+
+METRICS = (
+    ('write_seconds', TIME_BUCKETS),
+    ('first_byte_seconds', TIME_BUCKETS),
+    ('raw_bytes', SIZE_BUCKETS),
+    ('samples', SIZE_BUCKETS),
+    ('decode_seconds', TIME_BUCKETS),
+    ('passes', COUNT_BUCKETS),
+    ('retries', COUNT_BUCKETS),
+    ('truncated', COUNT_BUCKETS),
+    ('total_seconds', TIME_BUCKETS),
+)
+
+COMMAND_NAMES = {value: name[len('CMD_'):].lower() for name, value in vars(maple).items()
+        if name.startswith('CMD_')}
+
+class Histogram(object):
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'minimum', 'maximum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last is for values above every bound
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.minimum,
+            'max': self.maximum,
+            'mean': self.total / self.count if self.count else None,
+            'buckets': {str(bound): count for bound, count in zip(self.bounds + ('+Inf',), self.counts)},
+        }
+
+class TransactionRecord(object):
+    """
+    Totals for one transaction, filled in by the proxy as it goes.
+    """
+    __slots__ = ('command', 'started', 'write_seconds', 'first_byte_seconds', 'raw_bytes', 'samples',
+            'decode_seconds', 'passes', 'retries', 'truncated')
+
+    def __init__(self, command):
+        self.command = command
+        self.started = time.perf_counter()
+        self.write_seconds = 0.0
+        self.first_byte_seconds = 0.0
+        self.raw_bytes = 0
+        self.samples = 0
+        self.decode_seconds = 0.0
+        self.passes = 0
+        self.retries = 0
+        self.truncated = 0
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  # command label -> metric name -> Histogram
+
+    def start(self, command):
+        return TransactionRecord(command)
+
+    def finish(self, record):
+        total_seconds = time.perf_counter() - record.started
+        label = COMMAND_NAMES.get(record.command, record.command)
+        with self.lock:
+            histograms = self.histograms.get(label)
+            if histograms is None:
+                histograms = self.histograms[label] = {name: Histogram(bounds) for name, bounds in METRICS}
+            for name, _ in METRICS:
+                value = total_seconds if name == 'total_seconds' else getattr(record, name)
+                histograms[name].observe(value)
+
+    def as_dict(self):
+        with self.lock:
+            return {label: {name: histogram.as_dict() for name, histogram in histograms.items()}
+                    for label, histograms in self.histograms.items()}
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix='maple'):
+        """
+        The histograms in the Prometheus text exposition format, labelled by command.
+        """
+        lines = []
+        with self.lock:
+            for name, _ in METRICS:
+                metric = '%s_transaction_%s' % (prefix, name)
+                lines.append('# TYPE %s histogram' % (metric,))
+                for label in sorted(self.histograms):
+                    histogram = self.histograms[label][name]
+                    cumulative = 0
+                    for bound, count in zip(histogram.bounds + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append('%s_bucket{command="%s",le="%s"} %d' % (metric, label, bound, cumulative))
+                    lines.append('%s_sum{command="%s"} %s' % (metric, label, repr(histogram.total)))
+                    lines.append('%s_count{command="%s"} %d' % (metric, label, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, filename):
+        """
+        Write the metrics to filename: Prometheus text if it ends in .prom, otherwise JSON.
+        """
+        with open(filename, 'w') as h:
+            h.write(self.to_prometheus() if filename.endswith('.prom') else self.to_json())
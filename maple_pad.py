@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+Poll a controller at a fixed rate, for using a Dreamcast pad as an input device.
+
+ControllerPoller sends CMD_GET_COND at the requested rate, decodes each reply straight into one of two
+preallocated ControllerState records, and calls back only when the state has changed. It keeps track
+of the achieved poll rate and of the latency from sending a poll to delivering its change.
+
+    def changed(state, previous, latency):
+        print(state.pressed())
+
+    poller = ControllerPoller(maple.MapleProxy(port), changed, rate=120)
+    poller.run()
+
+Any MapleProxy will do, including a maple_sched.ScheduledProxy sharing the bus with a VMU transfer.
+"""
+import time
+import struct
+import argparse
+import threading
+
+import maple
+
+DEFAULT_RATE = 60
+
+# The condition words as they arrive, after the header and function code: each 32-bit word is
+# byte-swapped, which leaves the LE button word big-endian and the rest in reverse order.
+CONDITION = struct.Struct('>BBHBBBB')
+CONDITION_OFFSET = 8
+
+class ControllerState(object):
+    __slots__ = ('buttons', 'ltrig', 'rtrig', 'joy_x', 'joy_y', 'joy_x2', 'joy_y2')
+
+    def __init__(self):
+        self.buttons = 0
+        self.ltrig = self.rtrig = 0
+        self.joy_x = self.joy_y = self.joy_x2 = self.joy_y2 = 0x80
+
+    def decode(self, frame):
+        """
+        Fill in from a CMD_GET_COND reply, as returned by transact. Buttons are set bits when pressed.
+        """
+        (self.ltrig, self.rtrig, buttons, self.joy_y2, self.joy_x2, self.joy_y,
+                self.joy_x) = CONDITION.unpack_from(frame, CONDITION_OFFSET)
+        self.buttons = ~buttons & 0xffff
+
+    def __eq__(self, other):
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def copy(self):
+        state = ControllerState()
+        for name in self.__slots__:
+            setattr(state, name, getattr(self, name))
+        return state
+
+    def pressed(self):
+        return [name for bit, name in enumerate(maple.BUTTONS) if self.buttons & (1 << bit)]
+
+    def __repr__(self):
+        return 'ControllerState(%s)' % (', '.join('%s=%r' % (name, getattr(self, name))
+            for name in self.__slots__),)
+
+def is_condition_reply(frame):
+    return (frame is not None and len(frame) >= CONDITION_OFFSET + CONDITION.size
+            and maple.get_command(frame) == maple.CMD_XFER_RESP
+            and struct.unpack_from('<I', frame, 4)[0] == maple.FN_CONTROLLER)
+
+class ControllerPoller(object):
+    def __init__(self, bus, callback, address=maple.ADDRESS_CONTROLLER, rate=DEFAULT_RATE):
+        """
+        callback(state, previous, latency) is called from the polling thread whenever the controller's
+        state changes. state and previous are reused for later polls: copy() them to keep them.
+        """
+        self.bus = bus
+        self.callback = callback
+        self.address = address
+        self.period = 1 / rate
+        self.state = ControllerState()
+        self.previous = ControllerState()
+        self.request = struct.pack('<I', maple.FN_CONTROLLER)
+        self.stopping = threading.Event()
+        self.thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.polls = 0
+        self.failed = 0
+        self.changes = 0
+        self.overruns = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.started = time.monotonic()
+
+    def poll(self):
+        """
+        Poll once, calling back if the state changed. Returns False if there was no valid reply.
+        """
+        sent = time.monotonic()
+        frame = self.bus.transact(maple.CMD_GET_COND, self.address, self.request)
+        self.polls += 1
+        if not is_condition_reply(frame):
+            self.failed += 1
+            return False
+
+        # Decode into the older record, so that the two are swapped only when something changed.
+        self.previous.decode(frame)
+        if self.previous != self.state:
+            self.state, self.previous = self.previous, self.state
+            self.changes += 1
+            latency = time.monotonic() - sent
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.callback(self.state, self.previous, latency)
+        return True
+
+    def run(self, duration=None):
+        """
+        Poll at the configured rate until stop() is called, or for duration seconds if given.
+        """
+        self.reset_stats()
+        next_tick = self.started
+        end = None if duration is None else self.started + duration
+        while not self.stopping.wait(max(0, next_tick - time.monotonic())):
+            if end is not None and time.monotonic() >= end:
+                break
+            self.poll()
+            next_tick += self.period
+            overrun = time.monotonic() - next_tick
+            if overrun > 0:
+                # Don't try to catch up on polls we were too slow for.
+                skipped = int(overrun // self.period) + 1
+                self.overruns += skipped
+                next_tick += skipped * self.period
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            'polls': self.polls,
+            'failed': self.failed,
+            'changes': self.changes,
+            'overruns': self.overruns,
+            'rate': self.polls / elapsed if elapsed else 0.0,
+            'mean_latency': self.total_latency / self.changes if self.changes else 0.0,
+            'max_latency': self.max_latency,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='Print controller changes as they happen')
+    parser.add_argument('-p', '--port', default=maple.PORT)
+    parser.add_argument('-r', '--rate', type=float, default=DEFAULT_RATE, help='polls per second')
+    parser.add_argument('-t', '--time', type=float, default=None, help='stop after this many seconds')
+    args = parser.parse_args()
+
+    bus = maple.connect(args.port)
+    bus.deviceInfo(maple.ADDRESS_CONTROLLER)
+
+    def changed(state, previous, latency):
+        print("%6.1fms Ltrig %3d Rtrig %3d Joy %3d,%3d Joy2 %3d,%3d %s" % (latency * 1000, state.ltrig,
+            state.rtrig, state.joy_x, state.joy_y, state.joy_x2, state.joy_y2, ', '.join(state.pressed())))
+
+    poller = ControllerPoller(bus, changed, rate=args.rate)
+    try:
+        poller.run(args.time)
+    except KeyboardInterrupt:
+        pass
+
+    stats = poller.stats()
+    print("%(polls)d polls at %(rate).1f/s, %(failed)d failed, %(overruns)d overruns, "
+          "latency %(mean_latency).4fs mean %(max_latency).4fs max" % stats)
+
+if __name__ == '__main__':
+    main()
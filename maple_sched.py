@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+Priority scheduling of transactions on a shared Maple bus.
+
+The controller and the VMU share one bus. A BusScheduler owns the MapleProxy and runs one frame at a
+time on it, always picking the highest-priority frame waiting. Bulk flash I/O therefore only runs in
+the gaps between real-time controller polls and interactive LCD updates, rather than starving them.
+Each pass of a long reply, and each retry, is a frame of its own, so a poll waits for at most one pass
+of a flash read. That is still the proxy sending its whole buffer over the serial line, about 0.2s at
+57600 baud even with compressed replies, so polls slow to a few a second while flash is being read.
+
+Each client gets a ScheduledProxy, which has the usual MapleProxy methods:
+
+    scheduler = BusScheduler(maple.MapleProxy(port))
+    scheduler.poll(1 / 60, lambda bus: bus.readController(maple.ADDRESS_CONTROLLER))
+    bulk = scheduler.proxy(PRIORITY_BULK)
+    data = bulk.readFlash(maple.ADDRESS_PERIPH1, 0, 0)
+"""
+import sys
+import time
+import heapq
+import argparse
+import itertools
+import threading
+import concurrent.futures
+
+import maple
+
+# Priority classes, most urgent first.
+PRIORITY_REALTIME = 0      # Input polling
+PRIORITY_INTERACTIVE = 1   # LCD updates
+PRIORITY_BULK = 2          # Flash reads and writes
+
+PRIORITY_NAMES = {PRIORITY_REALTIME: 'realtime', PRIORITY_INTERACTIVE: 'interactive',
+        PRIORITY_BULK: 'bulk'}
+
+class PriorityStats(object):
+    """
+    Totals for one priority class. Only updated or read under the scheduler's lock.
+    """
+    __slots__ = ('frames', 'total_wait', 'max_wait', 'deadlines', 'missed', 'errors')
+
+    def __init__(self):
+        self.frames = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.deadlines = 0
+        self.missed = 0
+        self.errors = 0  # Periodic task runs which raised
+
+    def as_dict(self):
+        return {
+            'frames': self.frames,
+            'mean_wait': self.total_wait / self.frames if self.frames else 0.0,
+            'max_wait': self.max_wait,
+            'deadlines': self.deadlines,
+            'missed_deadlines': self.missed,
+            'errors': self.errors,
+        }
+
+class BusScheduler(object):
+    def __init__(self, bus):
+        self.bus = bus
+        self.queue = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.stats = {priority: PriorityStats() for priority in PRIORITY_NAMES}
+        self.tasks = []
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, priority, command, recipient, data, deadline=None, **kwargs):
+        """
+        Queue a whole transaction. Returns a concurrent.futures.Future for its reply. deadline, if given,
+        is a time.monotonic() value by which the reply is needed; missing it is counted in the stats.
+        """
+        return self.call(priority, deadline, self.bus.transact, command, recipient, data, **kwargs)
+
+    def call(self, priority, deadline, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs), to be run with the bus to itself. Returns a Future for its result;
+        deadline as for submit.
+        """
+        future = concurrent.futures.Future()
+        job = (future, time.monotonic(), deadline, func, args, kwargs)
+        with self.condition:
+            if not self.running:
+                raise maple.MapleError("scheduler is closed")
+            heapq.heappush(self.queue, (priority, next(self.sequence), job))
+            self.condition.notify()
+        return future
+
+    def proxy(self, priority):
+        return ScheduledProxy(self, priority)
+
+    def poll(self, period, func, priority=PRIORITY_REALTIME):
+        """
+        Call func(proxy) every period seconds on its own thread, with each frame it sends due by the
+        end of its period. Returns the PeriodicTask.
+        """
+        task = PeriodicTask(self, period, func, priority)
+        self.tasks.append(task)
+        return task
+
+    def close(self):
+        for task in self.tasks:
+            task.stop()
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    def report(self):
+        with self.condition:
+            return {PRIORITY_NAMES[priority]: stats.as_dict() for priority, stats in self.stats.items()}
+
+    def count(self, priority, missed=0, errors=0):
+        """
+        Add to the missed deadlines and errors of a priority class, from any thread.
+        """
+        with self.condition:
+            self.stats[priority].missed += missed
+            self.stats[priority].errors += errors
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                priority, _, (future, queued, deadline, func, args, kwargs) = heapq.heappop(self.queue)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            stats = self.stats[priority]
+            wait = time.monotonic() - queued
+            with self.condition:
+                stats.frames += 1
+                stats.total_wait += wait
+                stats.max_wait = max(stats.max_wait, wait)
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+            if deadline is not None:
+                with self.condition:
+                    stats.deadlines += 1
+                    if time.monotonic() > deadline:
+                        stats.missed += 1
+
+class ScheduledProxy(maple.MapleProxy):
+    """
+    A MapleProxy whose frames are run by a BusScheduler at a fixed priority, rather than on a serial
+    port of its own. Passes are joined and retried here, with only the frames themselves run on the
+    bus. deadline, if set, is applied to every frame sent.
+    """
+    def __init__(self, scheduler, priority):
+        # Batches would hold the bus for their whole length, so frames are always scheduled singly:
+        # options are left off.
+        self._init_state()
+        self.scheduler = scheduler
+        self.priority = priority
+        self.deadline = None
+        # The calibration is our own, but what the bus has seen of the end-of-frame sequence holds here.
+        self.skip_calibration.end_bits = scheduler.bus.skip_calibration.end_bits
+
+    def transact(self, command, recipient, data, debug_write_filename=None, allow_repeats=False,
+            require_valid=False):
+        if self.scheduler.bus.runs_passes:
+            return maple.MapleProxy.transact(self, command, recipient, data, debug_write_filename,
+                    allow_repeats, require_valid)
+
+        # The bus can only run whole transactions.
+        future = self.scheduler.submit(self.priority, command, recipient, data, deadline=self.deadline,
+                debug_write_filename=debug_write_filename, allow_repeats=allow_repeats,
+                require_valid=require_valid)
+        return future.result()
+
+    def _transact_multiple(self, frame, recv_skip, debug_write_filename=None):
+        bus = self.scheduler.bus
+        return self.scheduler.call(self.priority, self.deadline, bus._transact_multiple, frame, recv_skip,
+                debug_write_filename).result()
+
+    def _before_retry(self):
+        # Wait without holding the bus.
+        time.sleep(self.retry_delay)
+        self.scheduler.call(self.priority, None, self.scheduler.bus._discard_input).result()
+
+class PeriodicTask(object):
+    """
+    Calls func(proxy) every period. A run which raises is counted in errors, and the exception kept in
+    last_error, but doesn't stop the task.
+    """
+    def __init__(self, scheduler, period, func, priority):
+        self.scheduler = scheduler
+        self.period = period
+        self.func = func
+        self.priority = priority
+        self.proxy = scheduler.proxy(priority)
+        self.runs = 0
+        self.errors = 0
+        self.last_error = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while not self.stopping.wait(max(0, next_tick - time.monotonic())):
+            self.proxy.deadline = next_tick + self.period
+            try:
+                self.func(self.proxy)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+                self.scheduler.count(self.priority, errors=1)
+            self.runs += 1
+
+            next_tick += self.period
+            overrun = time.monotonic() - next_tick
+            if overrun > 0:
+                # Ticks which passed while we were still busy are missed outright.
+                skipped = int(overrun // self.period) + 1
+                self.scheduler.count(self.priority, missed=skipped)
+                next_tick += skipped * self.period
+
+def main():
+    parser = argparse.ArgumentParser(description='Poll the controller while reading the VMU')
+    parser.add_argument('-p', '--port', default=maple.PORT)
+    parser.add_argument('-r', '--rate', type=float, default=60, help='controller polls per second')
+    parser.add_argument('-b', '--blocks', type=int, default=16, help='VMU blocks to read')
+    args = parser.parse_args()
+
+    bus = maple.connect(args.port)
+    bus.deviceInfo(maple.ADDRESS_CONTROLLER)
+    bus.deviceInfo(maple.ADDRESS_PERIPH1)
+
+    scheduler = BusScheduler(bus)
+    poller = scheduler.poll(1 / args.rate, lambda proxy: proxy.readController(maple.ADDRESS_CONTROLLER))
+    bulk = scheduler.proxy(PRIORITY_BULK)
+    start = time.monotonic()
+    for block_num in range(args.blocks):
+        bulk.readFlash(maple.ADDRESS_PERIPH1, block_num, 0)
+        sys.stdout.write(chr(13) + chr(27) + '[K' + 'Read block %d' % (block_num,))
+        sys.stdout.flush()
+    elapsed = time.monotonic() - start
+    scheduler.close()
+
+    print()
+    print("%d polls in %.2fs (%.1f/s)" % (poller.runs, elapsed, poller.runs / elapsed))
+    for name, stats in scheduler.report().items():
+        print("%-12s" % (name,), ', '.join('%s %s' % item for item in sorted(stats.items())))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+"""
+Joining together the passes of a reply too long for the proxy's receive buffer.
+
+Each pass after the first asks the proxy to skip part of the reply. Rather than trusting that the
+skip lands exactly where the previous pass stopped, the skip is chosen to start a little earlier, and the
+new pass is matched against the end of what's already been decoded, bit by bit. A pass which doesn't
+match anywhere near where it was expected is rejected rather than joined on, and so is one which
+matches in several places that disagree about the reply: the stitcher never guesses.
+
+The first pass decodes the frame's header, which gives the length of the whole frame. Once that much
+has been joined together the reply is complete, without waiting for a pass to see the lines go idle;
+a reply which goes idle before then was truncated. A pass which does run on to the idle lines ends
+with the few stray bits which the end-of-frame sequence decodes to. Short replies, which fit in their
+first pass, show how many there are, and that places the last pass of a long reply exactly.
+
+Where each pass really started, once the frame proves valid, is fed back into a SkipCalibration,
+which learns how many bits of reply each iteration of the proxy's skip loop covers. The proxy's timing doesn't have to match
+maple.SKIP_LOOP_LENGTH exactly.
+"""
+import math
+
+# Each pass is asked to start this many bits before the end of what's been decoded so far.
+OVERLAP_BITS = 64
+
+# The decoder can produce a stray bit or two at the start of a pass which begins mid-frame, so this many
+# bits at the start of each later pass are ignored.
+GUARD_BITS = 8
+
+# At least this many bits of a pass have to match the previous passes for it to be joined on.
+MIN_MATCH_BITS = 32
+
+# How far either side of the expected start of a pass to look for it.
+SEARCH_BITS = OVERLAP_BITS - GUARD_BITS - MIN_MATCH_BITS + 8
+
+# A pass which doesn't fit on is fetched again with twice the overlap, up to this much.
+MAX_OVERLAP_BITS = 1024
+
+# Joins kept when a pass fits in several places: enough for every position searched.
+MAX_ALTERNATIVES = 2 * SEARCH_BITS + 1
+
+# Older observations count for less, so that the calibration follows the proxy.
+CALIBRATION_DECAY = 0.98
+
+# Weight of the made-up observation the calibration starts with, that a pass with no skip starts at the
+# first bit. Real observations all have much the same recv_skip, so this is what gives the fit its slope
+# until there's a spread of them.
+PRIOR_WEIGHT = 0.05
+
+class SkipCalibration(object):
+    """
+    A running least-squares fit of the bit at which a pass starts against the recv_skip which was asked
+    for: start_bit = bits_per_loop * recv_skip - offset_bits. Until it has seen a long reply, it knows
+    nothing; it's then seeded with the nominal skip loop length and the reply's bits per sample.
+    """
+    def __init__(self, samples_per_loop):
+        self.nominal_samples_per_loop = samples_per_loop
+        # Stray bits decoded from the end-of-frame sequence, as shown by the last valid reply which showed
+        # them. This is seen directly rather than learnt from joins, so it's kept across reset().
+        self.end_bits = None
+        self.reset()
+
+    def reset(self):
+        """
+        Forget everything learnt, e.g. after a reply joined using this calibration turned out bad.
+        """
+        self.bits_per_sample = None
+        self.count = self.sum_x = self.sum_y = self.sum_xx = self.sum_xy = 0.0
+        self.num_observed = 0
+
+    @property
+    def seeded(self):
+        return self.bits_per_sample is not None
+
+    def seed(self, num_bits, num_samples):
+        """
+        Start from the nominal skip loop length, given that num_samples samples held num_bits bits.
+        """
+        self.bits_per_sample = num_bits / num_samples
+        self.bits_per_loop = self.nominal_samples_per_loop * self.bits_per_sample
+        self.offset_bits = 0.0
+        # The skip loop starts with the frame, so the line passes close to the origin. With this made-up
+        # observation there, the first real one gives the slope.
+        self._add(0, 0.0, PRIOR_WEIGHT)
+
+    def _add(self, recv_skip, start_bit, weight=1.0):
+        self.count = self.count * CALIBRATION_DECAY + weight
+        self.sum_x = self.sum_x * CALIBRATION_DECAY + weight * recv_skip
+        self.sum_y = self.sum_y * CALIBRATION_DECAY + weight * start_bit
+        self.sum_xx = self.sum_xx * CALIBRATION_DECAY + weight * recv_skip * recv_skip
+        self.sum_xy = self.sum_xy * CALIBRATION_DECAY + weight * recv_skip * start_bit
+
+    def _fit(self):
+        denominator = self.count * self.sum_xx - self.sum_x * self.sum_x
+        self.bits_per_loop = (self.count * self.sum_xy - self.sum_x * self.sum_y) / denominator
+        self.offset_bits = (self.bits_per_loop * self.sum_x - self.sum_y) / self.count
+
+    def observe(self, recv_skip, start_bit):
+        """
+        Record that a pass with this recv_skip was found to start at start_bit.
+        """
+        self._add(recv_skip, start_bit)
+        self._fit()
+        self.num_observed += 1
+
+    def start_bit(self, recv_skip):
+        return self.bits_per_loop * recv_skip - self.offset_bits
+
+    def recv_skip(self, start_bit):
+        """
+        The recv_skip which starts a pass no later than start_bit.
+        """
+        return max(0, min(0x7fff, math.floor((start_bit + self.offset_bits) / self.bits_per_loop)))
+
+    def samples_per_loop(self):
+        """
+        The skip loop length as calibrated, in samples.
+        """
+        return self.bits_per_loop / self.bits_per_sample
+
+def decoded_bits(rx_response):
+    """
+    Everything a pass decoded, including the checksum and any trailing partial byte, as (value, number
+    of bits) with the first bit most significant.
+    """
+    data = rx_response.result
+    if rx_response.checksum is not None:
+        data = data + bytes([rx_response.checksum])
+    partial, num_partial = rx_response.partial
+    return (int.from_bytes(data, 'big') << num_partial) | partial, len(data) * 8 + num_partial
+
+def bits_match(value, num_bits, offset, other, other_bits, length):
+    """
+    True if length bits of value starting at offset equal the first length bits of other.
+    """
+    mask = (1 << length) - 1
+    return ((value >> (num_bits - offset - length)) & mask) == ((other >> (other_bits - length)) & mask)
+
+class ReplyStitcher(object):
+    """
+    Joins the passes of one reply. add() each pass in turn, asking the proxy for next_skip() in between,
+    then take the frame from frame(). If a pass doesn't fit on, widen() the overlap and fetch it again.
+
+    Where the overlap is repetitive (a block of zeros, say) a pass fits equally well in several places.
+    The nearest few joins are all kept as long as they agree, differing only in how far they reach; if
+    they'd disagree about any bit of the reply, the pass is rejected as if it hadn't fitted, so that it's
+    fetched again with a wider overlap. The checksum is never used to choose between joins. Passes which
+    fitted in just one place, in a frame which proved valid, are fed back into the calibration.
+
+    Once the header has given the frame's length, a pass which runs into the end of the frame can only
+    start in one place, or one of a few before the end-of-frame sequence has been seen, however
+    repetitive the data. A join which puts the end of the frame anywhere else is rejected.
+
+    Passes are added until the reply has ended: it's completed, or it stopped with bytes missing.
+    """
+    def __init__(self, calibration):
+        self.calibration = calibration
+        # (value, number of bits, ((recv_skip, start bit), ...) for each pass which fitted in just one
+        # place), likeliest first. Each is a prefix of the longest.
+        self.alternatives = []
+        self.expected = None  # Length of the frame in bytes, from its header
+        self.completed = False
+        self.missing = 0  # Bytes short of expected, if the reply ended early
+        self.num_passes = 0
+        self.overlap = OVERLAP_BITS
+        self.observed = False
+        # Stray bits after the frame, seen by a first pass which completed it or worked out from a last
+        # pass which fitted in just one place. They go to the calibration if the frame proves valid.
+        self.end_bits = None
+
+    @property
+    def num_bits(self):
+        return self.alternatives[0][1] if self.alternatives else 0
+
+    @property
+    def ended(self):
+        """
+        True once there's no point fetching another pass: the reply is complete or was truncated.
+        """
+        return self.completed or self.missing > 0
+
+    def next_skip(self):
+        return self.calibration.recv_skip(self.num_bits - self.overlap)
+
+    def widen(self):
+        """
+        Start the next pass further back. Returns False once the overlap can't grow any more.
+        """
+        self.overlap *= 2
+        return self.overlap <= MAX_OVERLAP_BITS
+
+    def add(self, recv_skip, rx_response):
+        """
+        Join on a pass, fetched with recv_skip. Returns False if a later pass added nothing, either
+        because it couldn't be matched against what came before or because it ended no later.
+        """
+        value, num_bits = decoded_bits(rx_response)
+        self.num_passes += 1
+        if self.num_passes == 1:
+            self.expected = rx_response.expected
+            self.end_bits = rx_response.end_bits
+            self.alternatives, self.completed, self.missing = self._settle([(value, num_bits, ())],
+                    rx_response.completed)
+            if not self.calibration.seeded and not rx_response.completed and num_bits:
+                self.calibration.seed(num_bits, rx_response.num_samples)
+            return True
+
+        num_bits -= GUARD_BITS
+        value &= (1 << num_bits) - 1
+        expected = round(self.calibration.start_bit(recv_skip)) + GUARD_BITS
+        frame_bits = None if self.expected is None else self.expected * 8
+        end_bits = self.calibration.end_bits
+        joins = []
+        for prev_value, prev_bits, prev_joins in self.alternatives:
+            if frame_bits is not None and rx_response.completed:
+                # The pass ends with the frame, followed by the stray bits of the end-of-frame sequence:
+                # end_bits of them, or fewer than 8 if we don't know yet.
+                first = frame_bits - num_bits
+                window = range(first, first + 8) if end_bits is None else (first + end_bits,)
+                starts = [start for start in window
+                        if overlap_matches(prev_value, prev_bits, start, value, num_bits, MIN_MATCH_BITS)]
+            else:
+                starts = find_overlap(prev_value, prev_bits, expected, value, num_bits)
+            for start in starts:
+                if start + num_bits <= prev_bits:
+                    continue
+                if frame_bits is not None and not rx_response.completed and start + num_bits >= frame_bits + 8:
+                    # This would run past the end of the frame without the lines going idle.
+                    continue
+                joins.append((abs(start - expected), start, prev_value, prev_bits, prev_joins))
+        if not joins:
+            return False
+
+        joins.sort(key=lambda join: join[0])
+        placed = len(set(start for _, start, _, _, _ in joins)) == 1
+        alternatives = []
+        for _, start, prev_value, prev_bits, join_starts in joins[:MAX_ALTERNATIVES]:
+            joined = ((prev_value >> (prev_bits - start)) << num_bits) | value, start + num_bits
+            if all(joined != alternative[:2] for alternative in alternatives):
+                if placed:
+                    join_starts += ((recv_skip, start - GUARD_BITS),)
+                alternatives.append(joined + (join_starts,))
+
+        alternatives, completed, missing = self._settle(alternatives, rx_response.completed)
+        if not consistent(alternatives):
+            # The pass fits in places which disagree, such as either side of a byte in a long run of
+            # the same value. Rather than guess, it has to be fetched again from further back. Until the
+            # calibration has seen end_bits, a reply ending in such a run can't be joined at all.
+            return False
+        if placed and completed and rx_response.completed and frame_bits is not None:
+            self.end_bits = joins[0][1] + num_bits - frame_bits
+        self.alternatives, self.completed, self.missing = alternatives, completed, missing
+        self.overlap = OVERLAP_BITS
+        return True
+
+    def _settle(self, alternatives, pass_completed):
+        """
+        Return the alternatives, whether the reply is complete and how many bytes are missing from it. Once
+        any alternative reaches the end of the frame, only those which do are kept, cut to its length.
+        """
+        if self.expected is None:
+            # No header to go on, so the reply is over when the lines go idle.
+            return alternatives, pass_completed, 0
+
+        frame_bits = self.expected * 8
+        complete = []
+        for value, num_bits, join_starts in alternatives:
+            if num_bits >= frame_bits:
+                value >>= num_bits - frame_bits
+                if all(value != other for other, _, _ in complete):
+                    complete.append((value, frame_bits, join_starts))
+        if complete:
+            return complete, True, 0
+        if pass_completed:
+            return alternatives, False, self.expected - alternatives[0][1] // 8
+        return alternatives, False, 0
+
+    def frame(self, is_valid=None):
+        """
+        The reply so far, as (frame, checksum) like a single pass would give. The checksum is None unless
+        the reply is complete, in which case there's only one way it can have been joined. If
+        is_valid(frame, checksum) is given and the frame satisfies it, where its passes started is fed
+        back into the calibration.
+        """
+        value, num_bits, join_starts = self.alternatives[0] if self.alternatives else (0, 0, ())
+        data = (value >> (num_bits % 8)).to_bytes(num_bits // 8, 'big')
+        if self.completed and data:
+            candidate = data[:-1], data[-1]
+        else:
+            candidate = data, None
+        if is_valid is not None and not self.observed and is_valid(*candidate):
+            self.observed = True
+            for recv_skip, start_bit in join_starts:
+                self.calibration.observe(recv_skip, start_bit)
+            if self.end_bits is not None:
+                self.calibration.end_bits = self.end_bits
+        return candidate
+
+def consistent(alternatives):
+    """
+    True if the (value, number of bits, ...) alternatives agree wherever they overlap: each is a prefix
+    of the longest.
+    """
+    longest, longest_bits = max(alternatives, key=lambda alternative: alternative[1])[:2]
+    return all(longest >> (longest_bits - num_bits) == value for value, num_bits, _ in alternatives)
+
+def overlap_matches(value, num_bits, start, other, other_bits, min_bits):
+    """
+    True if other matches value from start on, for at least min_bits.
+    """
+    length = min(num_bits - start, other_bits)
+    return start >= 0 and length >= min_bits and bits_match(value, num_bits, start, other, other_bits, length)
+
+def find_overlap(value, num_bits, expected, other, other_bits):
+    """
+    Positions in value at which other fits: those nearest expected, nearest first, or failing that, the
+    only position anywhere at which the whole overlap matches.
+    """
+    window = range(max(0, expected - SEARCH_BITS), expected + SEARCH_BITS + 1)
+    nearby = sorted((start for start in window
+        if overlap_matches(value, num_bits, start, other, other_bits, MIN_MATCH_BITS)),
+            key=lambda start: abs(start - expected))
+    if nearby:
+        return nearby[:MAX_ALTERNATIVES]
+
+    # Nowhere near: the calibration may be a long way out. Only trust an unambiguous match.
+    found = [start for start in range(num_bits - 2 * MIN_MATCH_BITS, -1, -1)
+            if overlap_matches(value, num_bits, start, other, other_bits, 2 * MIN_MATCH_BITS)]
+    return found if len(found) == 1 else []
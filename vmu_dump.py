@@ -1,13 +1,33 @@
 import os
 import sys
-import maple
+import mmap
+import zlib
+import queue
+import struct
 import argparse
+import threading
+
+import maple
+import vmu_flash
 
 LAST_BLOCK = 255
+DEFAULT_PIPELINE_DEPTH = 2
+
+# Blocks read per batch, when the proxy supports batches. Keeps progress output ticking over.
+BATCH_BLOCKS = 8
+
+# Dumps are accompanied by a manifest with this suffix, holding a status byte and the CRC-32 of each
+# block.
+MANIFEST_SUFFIX = '.manifest'
+MANIFEST_ENTRY = struct.Struct('<BI')
 
-def read_vmu(port, start_block=0, end_block=LAST_BLOCK):
-    bus = maple.MapleProxy(port)
+# Block statuses. BLOCK_BAD is never stored: it's reported when a block doesn't match its checksum.
+BLOCK_MISSING = 0
+BLOCK_OK = 1
+BLOCK_FREE = 2  # Free according to the FAT, so not read; stored as zeros.
+BLOCK_BAD = 3
 
+def enumerate_bus(bus):
     # Quick bus enumeration
     bus.deviceInfo(maple.ADDRESS_CONTROLLER)
     bus.deviceInfo(maple.ADDRESS_PERIPH1)
@@ -16,33 +36,252 @@ def read_vmu(port, start_block=0, end_block=LAST_BLOCK):
     bus.getCond(maple.ADDRESS_PERIPH1, maple.FN_CLOCK)
     bus.getMemInfo(maple.ADDRESS_PERIPH1)
 
-    for block_num in range(start_block, end_block + 1):
-        sys.stdout.write(chr(13) + chr(27) + '[K' + 'Reading block %d of 255' % (block_num,))
-        sys.stdout.flush()
-        data = bus.readFlash(maple.ADDRESS_PERIPH1, block_num, 0)
+def show_progress(block_num):
+    sys.stdout.write(chr(13) + chr(27) + '[K' + 'Reading block %d of 255' % (block_num,))
+    sys.stdout.flush()
+
+def read_vmu(port, start_block=0, end_block=LAST_BLOCK, bus=None, depth=0):
+    if bus is None:
+        bus = maple.connect(port)
+
+    enumerate_bus(bus)
+
+    for block_num, data in read_blocks(bus, range(start_block, end_block + 1), depth):
+        show_progress(block_num)
         yield data
 
+def used_blocks(read_block, log=print):
+    """
+    Return the set of blocks in use according to the root block and FAT, plus the system area, reading
+    blocks with read_block(block_num). If the card isn't formatted, every block is considered in use.
+    """
+    try:
+        root_info = vmu_flash.parse_root_block(read_block(vmu_flash.ROOT_BLOCK_IDX))
+    except vmu_flash.ImageError as e:
+        log("%s: reading every block" % (e,))
+        return set(range(LAST_BLOCK + 1))
+
+    fat_bytes = b''.join(read_block(root_info.fat_block - idx) for idx in range(root_info.fat_size))
+    fat = vmu_flash.parse_fat(fat_bytes)
+
+    blocks = vmu_flash.system_blocks(root_info)
+    blocks.update(block_num for block_num in range(LAST_BLOCK + 1) if fat[block_num] != vmu_flash.FAT_FREE)
+    return blocks
+
+def read_blocks(bus, block_nums, depth, missing_ok=False):
+    """
+    Yield (block number, data) for each block, pipelined if depth is non-zero. A block which can't be
+    read raises MapleError, or if missing_ok is set, is yielded with data None.
+    """
+    if depth:
+        return read_blocks_pipelined(bus, block_nums, depth, missing_ok)
+    return read_blocks_batched(bus, block_nums, missing_ok)
+
+def read_blocks_batched(bus, block_nums, missing_ok=False):
+    """
+    Yield (block number, data) for each block, reading BATCH_BLOCKS at a time. As read_blocks.
+    """
+    block_nums = list(block_nums)
+    for start in range(0, len(block_nums), BATCH_BLOCKS):
+        batch = block_nums[start : start + BATCH_BLOCKS]
+        try:
+            blocks = bus.readFlashBlocks(maple.ADDRESS_PERIPH1, batch)
+        except maple.MapleError:
+            if not missing_ok:
+                raise
+            # Keep whichever blocks of the batch can be read on their own.
+            blocks = [read_block_or_none(bus, block_num) for block_num in batch]
+        for block_num, data in zip(batch, blocks):
+            yield block_num, data
+
+def read_block_or_none(bus, block_num):
+    try:
+        return bus.readFlash(maple.ADDRESS_PERIPH1, block_num, 0)
+    except maple.MapleError:
+        return None
+
+def read_blocks_pipelined(bus, block_nums, depth, missing_ok=False):
+    """
+    Read blocks on a background thread, which runs up to depth blocks ahead of the consumer, so that the
+    next request is already on the wire while the caller writes out the previous block. Yields
+    (block number, data) in order, as read_blocks.
+    """
+    blocks = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for block_num, data in read_blocks_batched(bus, block_nums, missing_ok):
+                if not put((block_num, data, None)):
+                    return
+        except Exception as e:
+            put((None, None, e))
+        else:
+            put((None, None, None))
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block_num, data, error = blocks.get()
+            if error is not None:
+                raise error
+            if block_num is None:
+                break
+            yield block_num, data
+    finally:
+        # Don't leave the reader talking to the bus if the consumer gives up early.
+        stop.set()
+        thread.join()
+
+class DumpImage(object):
+    """
+    A pre-sized, memory-mapped card image, plus a manifest holding the status and CRC-32 of each block.
+    Blocks can be written in any order, and resuming a dump only needs to re-read blocks which are
+    missing or whose contents no longer match their checksum.
+    """
+    def __init__(self, filename, num_blocks=LAST_BLOCK + 1, log=print):
+        self.filename = filename
+        self.num_blocks = num_blocks
+        manifest_filename = filename + MANIFEST_SUFFIX
+
+        adopt_blocks = 0
+        if os.path.exists(filename) and not os.path.exists(manifest_filename):
+            # A dump from before manifests existed: trust its whole blocks, as the old append-only
+            # resume did.
+            adopt_blocks = min(os.stat(filename).st_size // vmu_flash.BLOCK_SIZE, num_blocks)
+
+        self.image_handle = self._open_sized(filename, num_blocks * vmu_flash.BLOCK_SIZE)
+        self.manifest_handle = self._open_sized(manifest_filename, num_blocks * MANIFEST_ENTRY.size)
+        self.image = mmap.mmap(self.image_handle.fileno(), 0)
+        self.manifest = mmap.mmap(self.manifest_handle.fileno(), 0)
+
+        if adopt_blocks:
+            log('Adopting %d blocks from previous file' % (adopt_blocks,))
+            for block_num in range(adopt_blocks):
+                self.set_status(block_num, BLOCK_OK)
+
+    @staticmethod
+    def _open_sized(filename, size):
+        handle = open(filename, 'r+b' if os.path.exists(filename) else 'w+b')
+        handle.truncate(size)
+        return handle
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.image.flush()
+        self.manifest.flush()
+        self.image.close()
+        self.manifest.close()
+        self.image_handle.close()
+        self.manifest_handle.close()
+
+    def block(self, block_num):
+        """
+        A zero-copy view of a block.
+        """
+        offset = block_num * vmu_flash.BLOCK_SIZE
+        return memoryview(self.image)[offset : offset + vmu_flash.BLOCK_SIZE]
+
+    def write_block(self, block_num, data, status=BLOCK_OK):
+        assert len(data) == vmu_flash.BLOCK_SIZE
+        offset = block_num * vmu_flash.BLOCK_SIZE
+        self.image[offset : offset + vmu_flash.BLOCK_SIZE] = data
+        self.set_status(block_num, status)
+
+    def set_status(self, block_num, status):
+        MANIFEST_ENTRY.pack_into(self.manifest, block_num * MANIFEST_ENTRY.size, status,
+                zlib.crc32(self.block(block_num)))
+
+    def status(self, block_num):
+        status, crc = MANIFEST_ENTRY.unpack_from(self.manifest, block_num * MANIFEST_ENTRY.size)
+        if status != BLOCK_MISSING and crc != zlib.crc32(self.block(block_num)):
+            return BLOCK_BAD
+        return status
+
+    def blocks_with_status(self, status):
+        return [block_num for block_num in range(self.num_blocks) if self.status(block_num) == status]
+
+def dump_image(bus, image, sparse=False, depth=0, progress=show_progress, log=print):
+    """
+    Fill in a DumpImage from the card, reading only blocks which aren't already good. If sparse is set,
+    blocks which are free according to the FAT are stored as zeros with status BLOCK_FREE instead of
+    being read. progress(block_num) is called as each block arrives, and other messages go to log.
+    Only a block whose reply proved valid is marked BLOCK_OK; one which can't be read is left
+    BLOCK_MISSING, to be read again when the dump is resumed. Returns the number of blocks read.
+    """
+    enumerate_bus(bus)
+
+    num_read = 0
+    def read_block(block_num):
+        nonlocal num_read
+        if image.status(block_num) != BLOCK_OK:
+            image.write_block(block_num, bus.readFlash(maple.ADDRESS_PERIPH1, block_num, 0))
+            num_read += 1
+        return image.block(block_num)
+
+    wanted = set(range(image.num_blocks))
+    if sparse:
+        wanted = used_blocks(read_block, log)
+        empty = bytes(vmu_flash.BLOCK_SIZE)
+        for block_num in set(range(image.num_blocks)) - wanted:
+            image.write_block(block_num, empty, BLOCK_FREE)
+
+    needed = [block_num for block_num in sorted(wanted) if image.status(block_num) != BLOCK_OK]
+    missing = 0
+    for block_num, data in read_blocks(bus, needed, depth, missing_ok=True):
+        progress(block_num)
+        if data is None:
+            image.set_status(block_num, BLOCK_MISSING)
+            missing += 1
+            continue
+        image.write_block(block_num, data)
+        num_read += 1
+
+    if missing:
+        log("%d blocks couldn't be read; run the dump again to retry them" % (missing,))
+    return num_read
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--port', default=maple.PORT)
+    parser.add_argument('-d', '--depth', type=int, default=DEFAULT_PIPELINE_DEPTH,
+            help='blocks to read ahead of the writer (0 to disable pipelining)')
+    parser.add_argument('-s', '--sparse', action='store_true',
+            help='only read blocks which are in use; free blocks are stored as zeros')
+    parser.add_argument('-m', '--metrics', default=None,
+            help='save transaction metrics here (Prometheus text if it ends in .prom, otherwise JSON)')
     parser.add_argument('filename')
     args = parser.parse_args()
 
-    open_mode = 'wb'
-    start_block = 0
+    with DumpImage(args.filename) as image:
+        bad = image.blocks_with_status(BLOCK_BAD)
+        if bad:
+            print('Re-reading %d blocks which fail their checksum' % (len(bad),))
 
-    if os.path.exists(args.filename):
-        size = os.stat(args.filename).st_size
-        if size % 512 == 0:
-            print('Extending previous file')
-            open_mode = 'ab'
-            start_block = size // 512
+        bus = maple.connect(args.port)
+        if args.metrics:
+            import maple_metrics
+            bus.metrics = maple_metrics.Metrics()
+        num_read = dump_image(bus, image, sparse=args.sparse, depth=args.depth)
 
-    with open(args.filename, open_mode) as handle:
-        for block in read_vmu(args.port, start_block=start_block):
-            handle.write(block)
-            handle.flush()
+    print('\nRead %d of %d blocks' % (num_read, LAST_BLOCK + 1))
+    if args.metrics:
+        bus.metrics.save(args.metrics)
 
 if __name__ == '__main__':
     main()
-
@@ -1,8 +1,10 @@
 import os
 import sys
+import mmap
 import time
 import struct
 import argparse
+import collections
 
 import maple
 
@@ -13,34 +15,86 @@ DIRECTORY_BLOCK_RANGE = (241, 253)
 FAT_BLOCK_IDX = 254
 ROOT_BLOCK_IDX = 255
 
+# FAT entries
+FAT_FREE = 0xfffc
+FAT_END = 0xfffa
+
+ROOT_BLOCK_MAGIC = b'\x55' * 16
+
+# Filesystem layout, as described by the root block.
+RootInfo = collections.namedtuple('RootInfo', ('fat_block', 'fat_size', 'dir_block', 'dir_size',
+    'icon', 'user_blocks'))
+
 class ImageError(Exception):
     pass
 
-def write_vmu(fs_image, port):
-    bus = maple.MapleProxy(port)
+def print_progress(block_num):
+    print(block_num)
+
+def write_vmu(fs_image, port, bus=None, reference=None, readback=False, progress=print_progress, log=print,
+        written=None):
+    """
+    Write fs_image (a dict mapping block number to block) to the VMU, calling progress(block_num) before
+    each block. Other messages go to log. The numbers of the blocks really written are appended to
+    written, if given.
+
+    If a reference image of the card's current contents is given (e.g. an earlier vmu_dump), or readback
+    is set to read each block from the card first, only the 128-byte phases which differ are written,
+    and blocks which are already correct are skipped entirely. Returns the number of bytes not sent.
+    """
+    if bus is None:
+        bus = maple.connect(port)
     
     # Quick bus enumeration
     bus.deviceInfo(maple.ADDRESS_CONTROLLER)
     bus.deviceInfo(maple.ADDRESS_PERIPH1)
     bus.getMemInfo(maple.ADDRESS_PERIPH1)
 
-    print("Writing %d blocks..." % (len(fs_image)))
+    bytes_skipped = 0
+
+    log("Writing %d blocks..." % (len(fs_image)))
     for block_num in sorted(fs_image.keys()):
-        print(block_num)
-        #orig_data = bus.readFlash(maple.ADDRESS_PERIPH1, block_num, 0)
+        progress(block_num)
 
         target_data = fs_image[block_num]
         assert len(target_data) == BLOCK_SIZE
 
-        for phase_num in range(BLOCK_SIZE // WRITE_SIZE):
-            #print block_num, phase_num
-            data = target_data[phase_num * WRITE_SIZE : (phase_num + 1) * WRITE_SIZE]
-            bus.writeFlash(maple.ADDRESS_PERIPH1, block_num, phase_num, data)
+        if readback:
+            orig_data = bus.readFlash(maple.ADDRESS_PERIPH1, block_num, 0)
+        elif reference is not None:
+            orig_data = reference[block_num * BLOCK_SIZE : (block_num + 1) * BLOCK_SIZE]
+        else:
+            orig_data = None
+
+        phases = changed_phases(orig_data, target_data)
+        bytes_skipped += (BLOCK_SIZE // WRITE_SIZE - len(phases)) * WRITE_SIZE
+        if not phases:
+            continue
+
+        bus.writeFlashBlock(maple.ADDRESS_PERIPH1, block_num, target_data, phases)
+        if written is not None:
+            written.append(block_num)
+
+    if reference is not None or readback:
+        log("Skipped %d of %d bytes already on the card" % (bytes_skipped, len(fs_image) * BLOCK_SIZE))
+
+    return bytes_skipped
+
+def changed_phases(orig_data, target_data):
+    """
+    Return the write phases of a block which differ between orig_data and target_data. All of them if
+    orig_data is unknown (None or short).
+    """
+    num_phases = BLOCK_SIZE // WRITE_SIZE
+    if orig_data is None or len(orig_data) != BLOCK_SIZE:
+        return list(range(num_phases))
 
-        bus.writeFlashComplete(maple.ADDRESS_PERIPH1, block_num)
+    return [phase_num for phase_num in range(num_phases)
+            if orig_data[phase_num * WRITE_SIZE : (phase_num + 1) * WRITE_SIZE] !=
+                target_data[phase_num * WRITE_SIZE : (phase_num + 1) * WRITE_SIZE]]
     
 def read_vmu():
-    bus = maple.MapleProxy()
+    bus = maple.connect()
 
     # Quick bus enumeration
     bus.deviceInfo(maple.ADDRESS_CONTROLLER)
@@ -83,9 +137,14 @@ def dump_hex(block):
 
 def read_vmu_dump(fn):
     """
-    Return a blocksize-padded image.
+    Return a blocksize-padded image. Where the file is already a whole number of blocks, this is a
+    read-only memoryview of the mapped file, so slicing it doesn't copy.
     """
     with open(fn, 'rb') as h:
+        size = os.fstat(h.fileno()).st_size
+        if size and size % BLOCK_SIZE == 0:
+            return memoryview(mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ))
+
         image_data = h.read()
 
     return pad_to_block_size(image_data)
@@ -99,7 +158,8 @@ def construct_8_3_filename(filename):
 
 def construct_fs_image(filename, data):
     """
-    Construct a file system image consisting of a dict mapping block number to block.
+    Construct a file system image consisting of a dict mapping block number to block. Blocks taken from
+    data are slices of it, so a memoryview from read_vmu_dump isn't copied.
     """
     fs_image = {}
 
@@ -132,19 +192,19 @@ def construct_fs_image(filename, data):
         dump_hex(fs_image[DIRECTORY_BLOCK_IDX])
 
         # construct the FAT block
-        fat_list = [0xfffc] * 256  # empty space initially
+        fat_list = [FAT_FREE] * 256  # empty space initially
 
         # add the game...
         for i in range(len(data) // BLOCK_SIZE):
             fat_list[i] = i + 1
-        fat_list[(len(data) // BLOCK_SIZE) - 1] = 0xfffa
+        fat_list[(len(data) // BLOCK_SIZE) - 1] = FAT_END
 
         # add the system blocks
         for i in range(DIRECTORY_BLOCK_RANGE[0] + 1, DIRECTORY_BLOCK_RANGE[1] + 1):
             fat_list[i] = i - 1
-        fat_list[DIRECTORY_BLOCK_RANGE[0]] = 0xfffa
-        fat_list[FAT_BLOCK_IDX] = 0xfffa
-        fat_list[ROOT_BLOCK_IDX] = 0xfffa
+        fat_list[DIRECTORY_BLOCK_RANGE[0]] = FAT_END
+        fat_list[FAT_BLOCK_IDX] = FAT_END
+        fat_list[ROOT_BLOCK_IDX] = FAT_END
 
         fat_bytes = b''.join(struct.pack('<H', entry) for entry in fat_list)
 
@@ -179,9 +239,37 @@ def construct_fs_image(filename, data):
 
     return fs_image
 
+def parse_root_block(block):
+    """
+    Return the RootInfo for a root block, as written by construct_fs_image.
+    """
+    if block[:len(ROOT_BLOCK_MAGIC)] != ROOT_BLOCK_MAGIC:
+        raise ImageError("Root block is not formatted")
+
+    return RootInfo(*struct.unpack('<HHHHHH', block[0x46:0x52]))
+
+def parse_fat(fat_bytes):
+    """
+    Return the FAT as a list with one entry per block: the next block in the chain, FAT_END or FAT_FREE.
+    """
+    return list(struct.unpack('<%dH' % (len(fat_bytes) // 2,), fat_bytes))
+
+def system_blocks(root_info):
+    """
+    The blocks used by the root block, FAT and directory. The FAT and directory grow downwards.
+    """
+    blocks = {ROOT_BLOCK_IDX}
+    blocks.update(root_info.fat_block - i for i in range(root_info.fat_size))
+    blocks.update(root_info.dir_block - i for i in range(root_info.dir_size))
+    return blocks
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--port', default=maple.PORT)
+    parser.add_argument('-r', '--reference', default=None,
+            help='dump of the card\'s current contents: only write what differs from it')
+    parser.add_argument('--readback', action='store_true',
+            help='read each block before writing it, and only write what differs')
     parser.add_argument('image')
 
     args = parser.parse_args()
@@ -191,6 +279,7 @@ if __name__ == '__main__':
     vmu_dump = read_vmu_dump(args.image)
     fs_image = construct_fs_image(args.image, vmu_dump)
 
-    write_vmu(fs_image, args.port)
+    reference = read_vmu_dump(args.reference) if args.reference else None
+    write_vmu(fs_image, args.port, reference=reference, readback=args.readback)
 
     print("%s written" % (args.image))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+Dump or flash the VMUs on several proxies at once.
+
+Each proxy gets its own worker thread, which runs an ordinary vmu_dump or vmu_flash job against it.
+Almost all of a job's time is spent waiting on its serial port, so the workers overlap well and a tray
+of cards takes about as long as one card. A card which fails doesn't stop the others; failures are
+listed at the end, along with the total throughput.
+
+    python3 vmu_fleet.py dump -o 'dump-{name}.bin'
+    python3 vmu_fleet.py -p /dev/ttyUSB0 -p /dev/ttyUSB1 flash game.bin
+
+With no --port, every USB serial port found is used.
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import threading
+import concurrent.futures
+
+import maple
+import vmu_dump
+import vmu_flash
+
+PORT_PATTERNS = ('/dev/ttyUSB*', '/dev/ttyACM*', '/dev/tty.usbserial-*', '/dev/tty.usbmodem*')
+PROGRESS_INTERVAL = 0.5
+
+def find_ports():
+    ports = []
+    for pattern in PORT_PATTERNS:
+        ports.extend(sorted(glob.glob(pattern)))
+    return ports
+
+def port_name(port):
+    return os.path.basename(port)
+
+class FleetProgress(object):
+    """
+    Blocks done on each port, updated from the workers and shown on one status line. Messages from the
+    workers are queued, and printed above the status line when it's next shown.
+    """
+    def __init__(self, ports):
+        self.lock = threading.Lock()
+        self.blocks = {port: 0 for port in ports}
+        self.state = {port: 'waiting' for port in ports}
+        self.messages = []
+        self.started = time.monotonic()
+
+    def log_for(self, port):
+        """
+        A log function for the worker on port.
+        """
+        def log(message):
+            with self.lock:
+                self.messages.append('%s: %s' % (port_name(port), message))
+        return log
+
+    def block_done(self, port):
+        with self.lock:
+            self.blocks[port] += 1
+
+    def set_state(self, port, state):
+        with self.lock:
+            self.state[port] = state
+
+    def total_blocks(self):
+        with self.lock:
+            return sum(self.blocks.values())
+
+    def line(self):
+        with self.lock:
+            parts = ['%s %s %d' % (port_name(port), self.state[port], self.blocks[port]) for port in self.blocks]
+            total = sum(self.blocks.values())
+        elapsed = time.monotonic() - self.started
+        rate = total * vmu_flash.BLOCK_SIZE / elapsed / 1024 if elapsed else 0.0
+        return '%s | %d blocks, %.1f KB/s' % (', '.join(parts), total, rate)
+
+    def show(self):
+        with self.lock:
+            messages, self.messages = self.messages, []
+        for message in messages:
+            sys.stdout.write(chr(13) + chr(27) + '[K' + message + '\n')
+        sys.stdout.write(chr(13) + chr(27) + '[K' + self.line())
+        sys.stdout.flush()
+
+def dump_job(port, progress, filename, sparse=False, depth=vmu_dump.DEFAULT_PIPELINE_DEPTH):
+    """
+    Dump the card on port to filename, resuming an earlier dump if there is one. Returns the number of
+    blocks read.
+    """
+    log = progress.log_for(port)
+    with vmu_dump.DumpImage(filename, log=log) as image:
+        bus = maple.connect(port, log=log)
+        try:
+            progress.set_state(port, 'reading')
+            return vmu_dump.dump_image(bus, image, sparse=sparse, depth=depth,
+                    progress=lambda block_num: progress.block_done(port), log=log)
+        finally:
+            bus.handle.close()
+
+def flash_job(port, progress, fs_image, readback=False):
+    """
+    Write fs_image to the card on port. Returns the number of blocks written, which with readback leaves
+    out those already on the card.
+    """
+    log = progress.log_for(port)
+    written = []
+    bus = maple.connect(port, log=log)
+    try:
+        progress.set_state(port, 'writing')
+        vmu_flash.write_vmu(fs_image, port, bus=bus, readback=readback,
+                progress=lambda block_num: progress.block_done(port), log=log, written=written)
+    finally:
+        bus.handle.close()
+    return len(written)
+
+def run_fleet(ports, job):
+    """
+    Run job(port, progress) for every port at once. Returns a dict mapping each port to the job's result
+    or the exception it raised, and the FleetProgress.
+    """
+    progress = FleetProgress(ports)
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        futures = {pool.submit(job, port, progress): port for port in ports}
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=PROGRESS_INTERVAL)
+            for future in done:
+                port = futures[future]
+                error = future.exception()
+                results[port] = future.result() if error is None else error
+                progress.set_state(port, 'done' if error is None else 'failed')
+            progress.show()
+    sys.stdout.write('\n')
+    return results, progress
+
+def report(results, progress):
+    elapsed = time.monotonic() - progress.started
+    failed = {port: result for port, result in results.items() if isinstance(result, Exception)}
+    for port in sorted(results):
+        if port in failed:
+            print('%s: failed: %r' % (port, failed[port]))
+        else:
+            print('%s: %d blocks' % (port, results[port]))
+
+    total = progress.total_blocks()
+    print('%d of %d cards done, %d blocks in %.1fs (%.1f KB/s)' % (len(results) - len(failed), len(results),
+        total, elapsed, total * vmu_flash.BLOCK_SIZE / elapsed / 1024 if elapsed else 0.0))
+    return not failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Dump or flash VMUs on several proxies at once')
+    parser.add_argument('-p', '--port', action='append', default=None,
+            help='proxy serial port; repeat for each proxy (default: all USB serial ports)')
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    dump_parser = subparsers.add_parser('dump', help='dump every card to its own file')
+    dump_parser.add_argument('-o', '--output', default='vmu-{name}.bin',
+            help='filename for each dump; {name} is the port name and {index} its position')
+    dump_parser.add_argument('-s', '--sparse', action='store_true',
+            help='only read blocks which are in use; free blocks are stored as zeros')
+
+    flash_parser = subparsers.add_parser('flash', help='write the same image to every card')
+    flash_parser.add_argument('--readback', action='store_true',
+            help='read each block before writing it, and only write what differs')
+    flash_parser.add_argument('image')
+    args = parser.parse_args()
+
+    ports = args.port or find_ports()
+    if not ports:
+        print('No proxies found')
+        sys.exit(1)
+    print('Using %s' % (', '.join(ports),))
+
+    if args.action == 'dump':
+        filenames = {port: args.output.format(name=port_name(port), index=index)
+                for index, port in enumerate(ports)}
+        if len(set(filenames.values())) != len(ports):
+            print('--output must give each port its own file, e.g. with {name}')
+            sys.exit(1)
+        results, progress = run_fleet(ports, lambda port, progress: dump_job(port, progress,
+            filenames[port], sparse=args.sparse))
+    else:
+        fs_image = vmu_flash.construct_fs_image(args.image, vmu_flash.read_vmu_dump(args.image))
+        results, progress = run_fleet(ports, lambda port, progress: flash_job(port, progress, fs_image,
+            readback=args.readback))
+
+    if not report(results, progress):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
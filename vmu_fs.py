@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+Read files off a VMU file system without dumping the whole card.
+
+The root block, FAT and directory are only read when first needed, and the directory one block at a
+time, so finding a file usually costs the root block, the FAT and one directory block. A file is then
+read by following its FAT chain, touching only the blocks it occupies. Blocks come from a BlockSource,
+either a card on a proxy or an image file, and each is fetched only once.
+
+    python3 vmu_fs.py -p /dev/ttyUSB0 list
+    python3 vmu_fs.py -p /dev/ttyUSB0 get SONICADV_INT -o sonic.vms
+    python3 vmu_fs.py -i dump.bin list
+"""
+import sys
+import struct
+import argparse
+import collections
+
+import maple
+import vmu_dump
+import vmu_flash
+
+# Directory entries, as written by vmu_flash.construct_fs_image: file type, copy protection, first
+# block, name, BCD date, size in blocks, header offset in blocks, then reserved bytes.
+DIR_ENTRY = struct.Struct('<BBH12s8sHH4x')
+ENTRIES_PER_BLOCK = vmu_flash.BLOCK_SIZE // DIR_ENTRY.size
+
+FILE_TYPE_DATA = 0x33
+FILE_TYPE_GAME = 0xcc
+FILE_TYPE_NAMES = {FILE_TYPE_DATA: 'data', FILE_TYPE_GAME: 'game'}
+
+class DirEntry(collections.namedtuple('DirEntry', ('file_type', 'copy_protect', 'first_block', 'raw_name',
+        'date', 'size', 'header_offset'))):
+    """
+    One file in the directory. size is in blocks.
+    """
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return self.raw_name.rstrip(b'\x00 ').decode('ascii', 'replace')
+
+    def matches(self, name):
+        """
+        True if name is this file's name, or becomes it when made into an 8.3 name as vmu_flash does.
+        """
+        return name == self.name or vmu_flash.construct_8_3_filename(name).rstrip(b'\x00 ') == \
+                self.raw_name.rstrip(b'\x00 ')
+
+    def format_date(self):
+        century, year, month, day, hour, minute, second, _ = self.date
+        return '%02x%02x-%02x-%02x %02x:%02x:%02x' % (century, year, month, day, hour, minute, second)
+
+    def format(self):
+        return '%-12s %-4s %3d blocks  %s%s' % (self.name, FILE_TYPE_NAMES.get(self.file_type, '?'),
+            self.size, self.format_date(), '  copy protected' if self.copy_protect else '')
+
+class BlockSource(object):
+    """
+    Somewhere to read blocks from: fetch(block_nums) returns the contents of each. Every block fetched is
+    kept, so each is only read once; num_reads counts those which were really fetched.
+    """
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.cache = {}
+        self.num_reads = 0
+
+    def read_block(self, block_num):
+        return self.read_blocks([block_num])[0]
+
+    def read_blocks(self, block_nums):
+        """
+        Return the contents of each block, fetching together all those not already cached.
+        """
+        missing = [block_num for block_num in dict.fromkeys(block_nums) if block_num not in self.cache]
+        if missing:
+            for block_num, data in zip(missing, self.fetch(missing)):
+                self.cache[block_num] = data
+            self.num_reads += len(missing)
+        return [self.cache[block_num] for block_num in block_nums]
+
+def proxy_source(bus, address=maple.ADDRESS_PERIPH1):
+    """
+    A BlockSource for the card at address on a MapleProxy, read in batches where the proxy supports them.
+    """
+    return BlockSource(lambda block_nums: bus.readFlashBlocks(address, block_nums))
+
+def image_source(filename):
+    """
+    A BlockSource for an image file, such as one written by vmu_dump.
+    """
+    image = vmu_flash.read_vmu_dump(filename)
+
+    def fetch(block_nums):
+        blocks = []
+        for block_num in block_nums:
+            if (block_num + 1) * vmu_flash.BLOCK_SIZE > len(image):
+                raise vmu_flash.ImageError("Block %d is past the end of the image" % (block_num,))
+            offset = block_num * vmu_flash.BLOCK_SIZE
+            blocks.append(bytes(image[offset : offset + vmu_flash.BLOCK_SIZE]))
+        return blocks
+    return BlockSource(fetch)
+
+class Filesystem(object):
+    """
+    The file system on a BlockSource, parsed as far as it's needed. root_block is where to find the
+    root block, which is given by a card's MemInfo.
+    """
+    def __init__(self, source, root_block=vmu_flash.ROOT_BLOCK_IDX):
+        self.source = source
+        self.root_block = root_block
+        self._root_info = None
+        self._fat = None
+        self._entries = []  # Every entry in the directory blocks read so far
+        self._num_dir_blocks_read = 0
+
+    @property
+    def root_info(self):
+        if self._root_info is None:
+            self._root_info = vmu_flash.parse_root_block(self.source.read_block(self.root_block))
+        return self._root_info
+
+    @property
+    def fat(self):
+        if self._fat is None:
+            root_info = self.root_info
+            fat_blocks = self.source.read_blocks([root_info.fat_block - idx
+                for idx in range(root_info.fat_size)])
+            self._fat = vmu_flash.parse_fat(b''.join(fat_blocks))
+        return self._fat
+
+    def entries(self):
+        """
+        Yield every file in the directory, reading directory blocks only as they're reached. Slots which
+        don't hold a plausible data or game file (unused, or left over from something else) are skipped.
+        """
+        idx = 0
+        while True:
+            while idx < len(self._entries):
+                yield self._entries[idx]
+                idx += 1
+            if self._num_dir_blocks_read == self.root_info.dir_size:
+                return
+            # The directory grows downwards.
+            block = self.source.read_block(self.root_info.dir_block - self._num_dir_blocks_read)
+            self._num_dir_blocks_read += 1
+            for entry_idx in range(ENTRIES_PER_BLOCK):
+                entry = DirEntry(*DIR_ENTRY.unpack_from(block, entry_idx * DIR_ENTRY.size))
+                if self._plausible(entry):
+                    self._entries.append(entry)
+
+    def _plausible(self, entry):
+        num_blocks = len(self.fat)
+        return entry.file_type in FILE_TYPE_NAMES and entry.first_block < num_blocks and \
+                0 < entry.size <= num_blocks
+
+    def find(self, name):
+        """
+        Return the DirEntry for the named file, or None if there isn't one.
+        """
+        for entry in self.entries():
+            if entry.matches(name):
+                return entry
+        return None
+
+    def chain(self, first_block):
+        """
+        Return the blocks of the file starting at first_block, in order, by following the FAT.
+        """
+        fat = self.fat
+        blocks = []
+        block_num = first_block
+        while block_num != vmu_flash.FAT_END:
+            if block_num >= len(fat) or block_num in blocks:
+                raise vmu_flash.ImageError("Broken FAT chain from block %d at block %d" % (first_block,
+                    block_num))
+            blocks.append(block_num)
+            block_num = fat[block_num]
+        return blocks
+
+    def read_file(self, entry):
+        """
+        Return the contents of the file with this DirEntry, reading only the blocks in its chain.
+        """
+        blocks = self.chain(entry.first_block)
+        if len(blocks) != entry.size:
+            raise vmu_flash.ImageError("%s is %d blocks long, but its FAT chain has %d" % (entry.name,
+                entry.size, len(blocks)))
+        return b''.join(self.source.read_blocks(blocks))
+
+def main():
+    parser = argparse.ArgumentParser(description='List or extract files on a VMU')
+    source_group = parser.add_mutually_exclusive_group()
+    source_group.add_argument('-p', '--port', default=maple.PORT, help='read the card on this proxy')
+    source_group.add_argument('-i', '--image', default=None, help='read this image file instead')
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    subparsers.add_parser('list', help='list the files on the card')
+    get_parser = subparsers.add_parser('get', help='extract one file')
+    get_parser.add_argument('name')
+    get_parser.add_argument('-o', '--output', default=None, help='where to write it (default: its name)')
+    args = parser.parse_args()
+
+    if args.image:
+        fs = Filesystem(image_source(args.image))
+    else:
+        bus = maple.connect(args.port)
+        vmu_dump.enumerate_bus(bus)
+        meminfo = bus.getMemInfo(maple.ADDRESS_PERIPH1)
+        root_block = vmu_flash.ROOT_BLOCK_IDX if meminfo is None else meminfo.root_block
+        fs = Filesystem(proxy_source(bus), root_block)
+
+    try:
+        if args.action == 'list':
+            for entry in fs.entries():
+                print(entry.format())
+        else:
+            entry = fs.find(args.name)
+            if entry is None:
+                print("No file called %s" % (args.name,))
+                sys.exit(1)
+            data = fs.read_file(entry)
+            with open(args.output or entry.name, 'wb') as h:
+                h.write(data)
+            print("Wrote %d bytes to %s" % (len(data), args.output or entry.name))
+    except vmu_flash.ImageError as e:
+        print(e)
+        sys.exit(1)
+
+    print("%d blocks read" % (fs.source.num_reads,))
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,104 @@
 """
-Display an image on the VMU.
+Display an image, or play an animation, on the VMU.
 
-Image must be a text file containing 32 lines, each 48 characters long. Each
-character represents a pixel -- x for black and space for white.
+Each image must be a text file containing 32 lines, each 48 characters long. Each
+character represents a pixel -- x for black and space for white. Frame files, PGM
+and PBM images can also be used, via maple_lcd (which needs numpy).
+
+Given more than one image, they are played in order as an animation at --fps frames per second.
+Frames are packed once up front, frames identical to the one on screen aren't sent again, and frames
+are dropped rather than played late if the bus can't keep up.
 """
 import sys
+import time
 import argparse
 
 import maple
 
+DEFAULT_FPS = 10
+
+class PlaybackStats(object):
+    __slots__ = ('shown', 'sent', 'repeated', 'dropped', 'failed', 'elapsed')
+
+    def __init__(self):
+        self.shown = self.sent = self.repeated = self.dropped = self.failed = 0
+        self.elapsed = 0.0
+
+    def fps(self):
+        return self.shown / self.elapsed if self.elapsed else 0.0
+
+def play(bus, frames, fps=DEFAULT_FPS, loops=1, address=maple.ADDRESS_PERIPH1):
+    """
+    Play a sequence of 192-byte LCD images. Frame n of the whole run is due at start + n / fps, so a slow
+    frame doesn't push back the ones after it; a frame whose slot has already passed is dropped. Returns
+    a PlaybackStats.
+    """
+    payloads = [maple.lcd_payload(lcddata) for lcddata in frames]
+    total = len(payloads) * loops
+    period = 1 / fps
+    stats = PlaybackStats()
+    on_screen = None
+
+    start = time.monotonic()
+    frame_num = 0
+    while frame_num < total:
+        due = start + frame_num * period
+        now = time.monotonic()
+        if now < due:
+            time.sleep(due - now)
+        elif now >= due + period and frame_num < total - 1:
+            # Too late for this one: its successor is already due.
+            stats.dropped += 1
+            frame_num += 1
+            continue
+
+        payload = payloads[frame_num % len(payloads)]
+        if payload == on_screen:
+            stats.repeated += 1
+        else:
+            reply = bus.transact(maple.CMD_WRITE, address, payload)
+            stats.sent += 1
+            if reply and maple.get_command(reply) == maple.CMD_ACK_RESP:
+                on_screen = payload
+            else:
+                stats.failed += 1
+                on_screen = None
+        stats.shown += 1
+        frame_num += 1
+
+    stats.elapsed = time.monotonic() - start
+    return stats
+
+def load_frames(filename):
+    if filename == '-' or filename.endswith('.txt'):
+        return [maple.load_image(sys.stdin if filename == '-' else filename)]
+
+    import maple_lcd
+    return maple_lcd.load_frames(filename)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--port', default=maple.PORT)
-    parser.add_argument('filename')
+    parser.add_argument('-f', '--fps', type=float, default=DEFAULT_FPS, help='animation frame rate')
+    parser.add_argument('-l', '--loops', type=int, default=1, help='times to play the animation')
+    parser.add_argument('filenames', nargs='+')
     args = parser.parse_args()
 
-    if args.filename == '-':
-        image = maple.load_image(sys.stdin)
-    else:
-        image = maple.load_image(args.filename)
+    frames = []
+    for filename in args.filenames:
+        frames.extend(load_frames(filename))
 
-    bus = maple.MapleProxy(args.port)
+    bus = maple.connect(args.port)
     bus.deviceInfo(maple.ADDRESS_CONTROLLER)
     bus.deviceInfo(maple.ADDRESS_PERIPH1)
-    bus.writeLCD(maple.ADDRESS_PERIPH1, image)
+
+    if len(frames) == 1 and args.loops == 1:
+        bus.writeLCD(maple.ADDRESS_PERIPH1, frames[0])
+        return
+
+    stats = play(bus, frames, args.fps, args.loops)
+    print("%d frames in %.2fs (%.1f fps): %d sent, %d unchanged, %d dropped, %d failed" % (stats.shown,
+        stats.elapsed, stats.fps(), stats.sent, stats.repeated, stats.dropped, stats.failed))
 
 if __name__ == '__main__':
     main()